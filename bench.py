@@ -0,0 +1,246 @@
+#! python2
+
+############################
+#                          #
+# LANDS OF LOTHARIEL BENCH #
+#                          #
+############################
+
+#
+# Times the expensive parts of the game: map generation (with the rooms, bsp
+# and caves generators), finding the regions of a map, building the fov map,
+# computing the fov, rendering, a round of monster turns and the message log.
+# Runs at the normal map size and at bigger maps and monster counts, always
+# with the same seeds, and writes the results as json so they can be compared
+# against an earlier run.
+#
+#   python bench.py                          headless, results in bench_results.json
+#   python bench.py --render                 also time render_all (opens a window)
+#   python bench.py --baseline old.json      compare against an earlier run
+#
+
+import argparse
+import json
+import platform
+import sys
+import timeit
+
+import lothariel
+
+# (name, map width, map height, max rooms, max monsters per room)
+SCALES = [
+    ('stock', 80, 43, 25, 3),
+    ('crowded', 80, 43, 25, 12),
+    ('large', 160, 86, 100, 3),
+    ('huge', 320, 172, 400, 3),
+    ('huge-crowded', 320, 172, 400, 12),
+    ('vast', 1000, 1000, 5000, 3),
+]
+
+SEEDS = [1, 2, 3]
+
+LONG_MESSAGE = ('The radioactive rat attacks the player for 3 hit points, and the '
+    'player staggers back against the damp sewer wall. ') * 3
+
+# set the game up for one scale
+def use_scale(width, height, max_rooms, room_monsters):
+    lothariel.MAP_WIDTH = width
+    lothariel.MAP_HEIGHT = height
+    lothariel.MAX_ROOMS = max_rooms
+    lothariel.MAX_ROOM_MONSTERS = room_monsters
+
+# clear out the level, leaving just the player, ready for make_map
+def reset_level():
+    world = lothariel.world
+    for eid in list(world.objects):
+        if world.objects[eid] is not lothariel.player:
+            world.destroy(eid)
+    lothariel.object_index = lothariel.SpatialIndex()
+    lothariel.object_index.add(lothariel.player)
+    lothariel.scheduler = lothariel.Scheduler()
+
+# run func repeat times and return the timings in seconds. setup runs before
+# each call and isn't timed
+def time_it(func, repeat, setup=None):
+    times = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = timeit.default_timer()
+        func()
+        times.append(timeit.default_timer() - start)
+    return times
+
+def summary(name, scale, times, count=1):
+    times = sorted(times)
+    return {
+        'name': name,
+        'scale': scale,
+        'repeat': len(times),
+        'count': count,
+        'best': times[0],
+        'median': times[len(times) // 2],
+        'mean': sum(times) / len(times),
+    }
+
+def bench_scale(scale, repeat, render):
+    (name, width, height, max_rooms, room_monsters) = scale
+    use_scale(width, height, max_rooms, room_monsters)
+    results = []
+
+    for seed in SEEDS:
+        lothariel.new_game(seed)
+        tag = '%s/seed%d' % (name, seed)
+
+        # map generation, reseeding so every run makes the same map
+        def setup_mapgen():
+            lothariel.seed_rngs(seed)
+            reset_level()
+        results.append(summary('make_map', tag,
+            time_it(lothariel.make_map, repeat, setup_mapgen)))
+
+        # the same with the bsp and caves generators, leaving the rooms map in
+        # place after
+        lothariel.MAP_GENERATOR = 'bsp'
+        results.append(summary('make_map_bsp', tag,
+            time_it(lothariel.make_map, repeat, setup_mapgen)))
+        lothariel.MAP_GENERATOR = 'caves'
+        results.append(summary('make_map_caves', tag,
+            time_it(lothariel.make_map, repeat, setup_mapgen)))
+        lothariel.MAP_GENERATOR = 'rooms'
+        setup_mapgen()
+        rooms = lothariel.make_map()
+        monsters = len(lothariel.world.ai)
+
+        # labelling the floor and joining up the rooms of the map just made
+        results.append(summary('find_regions', tag,
+            time_it(lambda: lothariel.find_regions(lothariel.map, rooms), repeat)))
+
+        # building the fov map from the tiles
+        results.append(summary('initialize_fov', tag,
+            time_it(lothariel.initialize_fov, repeat)))
+
+        # fov from the player's spot
+        player = lothariel.player
+        def compute_fov():
+            lothariel.libtcod.map_compute_fov(lothariel.fov_map,
+                player.x - lothariel.local_x, player.y - lothariel.local_y,
+                lothariel.TORCH_RADIUS, lothariel.FOV_LIGHT_WALLS, lothariel.FOV_ALGO)
+        results.append(summary('map_compute_fov', tag, time_it(compute_fov, repeat)))
+
+        # one player turn's worth of monster turns. the player can't die, so
+        # every round is a full round. first as the level starts, with the
+        # monsters away from the player still asleep
+        lothariel.fov_recompute = True
+        lothariel.update_fov()
+        player.fighter.max_hp = player.fighter.hp = 10 ** 9
+        results.append(summary('monster_turns_asleep', tag,
+            time_it(lothariel.take_monster_turns, repeat), monsters))
+
+        # then with every monster awake. the ones far from the player doze off
+        # again on their turn, so they're woken before every round
+        def wake_all():
+            for obj in lothariel.world.query('ai'):
+                if obj.ai.asleep:
+                    lothariel.wake_monster(obj)
+        results.append(summary('monster_turns', tag,
+            time_it(lothariel.take_monster_turns, repeat, wake_all), monsters))
+
+        # the whole frame, from nothing drawn and with nothing changed
+        if render:
+            def full_frame():
+                lothariel.render_invalidate()
+                lothariel.fov_recompute = True
+            # count is the cells redrawn in the last frame
+            times = time_it(lothariel.render_all, repeat, full_frame)
+            results.append(summary('render_all_full', tag, times, lothariel.cells_redrawn))
+            times = time_it(lothariel.render_all, repeat)
+            results.append(summary('render_all_idle', tag, times, lothariel.cells_redrawn))
+
+    # collecting the leaves of a bsp split of the map, with a python callback
+    # for every node and with the one pass bsp_leaves
+    libtcod = lothariel.libtcod
+    leaf_size = lothariel.ROOM_MAX_SIZE + lothariel.BSP_ROOM_GAP
+    root = libtcod.bsp_new_with_size(0, 0, width, height)
+    libtcod.bsp_split_recursive(root, lothariel.rngs['mapgen'], lothariel.BSP_DEPTH,
+        leaf_size, leaf_size, lothariel.BSP_MAX_RATIO, lothariel.BSP_MAX_RATIO)
+    leaves = len(libtcod.bsp_leaves(root))
+    def traverse():
+        found = []
+        def visit(node, data):
+            if libtcod.bsp_is_leaf(node):
+                found.append((node.x, node.y, node.w, node.h))
+            return True
+        libtcod.bsp_traverse_pre_order(root, visit)
+    results.append(summary('bsp_traverse', name, time_it(traverse, repeat), leaves))
+    results.append(summary('bsp_leaves', name,
+        time_it(lambda: libtcod.bsp_leaves(root), repeat), leaves))
+    libtcod.bsp_delete(root)
+
+    # wrapping and adding messages to the log
+    def messages():
+        for i in range(100):
+            lothariel.message(LONG_MESSAGE)
+    results.append(summary('message', name, time_it(messages, repeat), 100))
+
+    return results
+
+# print each result, with the change from the baseline if there is one
+def report(results, baseline):
+    old = {}
+    if baseline is not None:
+        for result in baseline['results']:
+            old[(result['name'], result['scale'])] = result['best']
+
+    for result in results:
+        line = '%-18s %-22s %10.3f ms' % (
+            result['name'], result['scale'], result['best'] * 1000)
+        before = old.get((result['name'], result['scale']))
+        if before:
+            line += '   %6.2fx vs baseline' % (before / result['best'])
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description='Lands of Lothariel benchmarks')
+    parser.add_argument('--repeat', type=int, default=10,
+        help='times to run each benchmark (default 10)')
+    parser.add_argument('--render', action='store_true',
+        help='also time render_all, this opens a window')
+    parser.add_argument('--scale', action='append',
+        help='only run the named scale, can be given more than once')
+    parser.add_argument('--output', default='bench_results.json',
+        help='where to write the results (default bench_results.json)')
+    parser.add_argument('--baseline',
+        help='results from an earlier run to compare against')
+    args = parser.parse_args()
+
+    # no worker making levels in the background, it would skew the timings
+    lothariel.PREGENERATE = False
+
+    if args.render:
+        lothariel.init_console()
+        # the panel looks up what's under the mouse, normally set up by play_game
+        lothariel.mouse = lothariel.libtcod.Mouse()
+
+    results = []
+    for scale in SCALES:
+        if args.scale and scale[0] not in args.scale:
+            continue
+        results.extend(bench_scale(scale, args.repeat, args.render))
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'repeat': args.repeat,
+            'results': results,
+        }, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
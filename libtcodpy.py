@@ -914,9 +914,9 @@ def console_fill_foreground(con,r,g,b) :
     if (numpy_available and isinstance(r, numpy.ndarray) and
         isinstance(g, numpy.ndarray) and isinstance(b, numpy.ndarray)):
         #numpy arrays, use numpy's ctypes functions
-        r = numpy.ascontiguousarray(r, dtype=numpy.int_)
-        g = numpy.ascontiguousarray(g, dtype=numpy.int_)
-        b = numpy.ascontiguousarray(b, dtype=numpy.int_)
+        r = numpy.ascontiguousarray(r, dtype=numpy.intc)
+        g = numpy.ascontiguousarray(g, dtype=numpy.intc)
+        b = numpy.ascontiguousarray(b, dtype=numpy.intc)
         cr = r.ctypes.data_as(POINTER(c_int))
         cg = g.ctypes.data_as(POINTER(c_int))
         cb = b.ctypes.data_as(POINTER(c_int))
@@ -935,9 +935,9 @@ def console_fill_background(con,r,g,b) :
     if (numpy_available and isinstance(r, numpy.ndarray) and
         isinstance(g, numpy.ndarray) and isinstance(b, numpy.ndarray)):
         #numpy arrays, use numpy's ctypes functions
-        r = numpy.ascontiguousarray(r, dtype=numpy.int_)
-        g = numpy.ascontiguousarray(g, dtype=numpy.int_)
-        b = numpy.ascontiguousarray(b, dtype=numpy.int_)
+        r = numpy.ascontiguousarray(r, dtype=numpy.intc)
+        g = numpy.ascontiguousarray(g, dtype=numpy.intc)
+        b = numpy.ascontiguousarray(b, dtype=numpy.intc)
         cr = r.ctypes.data_as(POINTER(c_int))
         cg = g.ctypes.data_as(POINTER(c_int))
         cb = b.ctypes.data_as(POINTER(c_int))
@@ -952,7 +952,7 @@ def console_fill_background(con,r,g,b) :
 def console_fill_char(con,arr) :
     if (numpy_available and isinstance(arr, numpy.ndarray) ):
         #numpy arrays, use numpy's ctypes functions
-        arr = numpy.ascontiguousarray(arr, dtype=numpy.int_)
+        arr = numpy.ascontiguousarray(arr, dtype=numpy.intc)
         carr = arr.ctypes.data_as(POINTER(c_int))
     else:
         #otherwise convert using the struct module
@@ -1543,6 +1543,64 @@ def map_get_width(map):
 def map_get_height(map):
     return _lib.TCOD_map_get_height(map)
 
+# bulk access to a map's cells. the map is read straight out of the
+# TCOD_map_t structure in one copy, instead of one call per cell. each cell is a
+# byte with the transparent, walkable and fov bits (cell_t in libtcod_int.h)
+class _CMap(Structure):
+    _fields_ = [('width', c_int),
+                ('height', c_int),
+                ('nbcells', c_int),
+                ('cells', c_void_p),
+                ]
+
+MAP_CELL_TRANSPARENT = 1
+MAP_CELL_WALKABLE = 2
+MAP_CELL_FOV = 4
+
+def map_get_cells(m):
+    cmap = cast(c_void_p(m), POINTER(_CMap)).contents
+    return string_at(cmap.cells, cmap.nbcells), cmap.width, cmap.height
+
+# one of the cell bits for the whole map, as a height x width numpy array of
+# bools if numpy is available, otherwise a row-major bytearray of 0s and 1s
+def _map_get_cell_array(m, bit):
+    cells, w, h = map_get_cells(m)
+    if numpy_available:
+        arr = numpy.frombuffer(cells, dtype=numpy.uint8).reshape(h, w)
+        return (arr & bit) != 0
+    table = bytes(bytearray([1 if i & bit else 0 for i in range(256)]))
+    return bytearray(cells.translate(table))
+
+def map_get_fov_array(m):
+    return _map_get_cell_array(m, MAP_CELL_FOV)
+
+def map_get_transparent_array(m):
+    return _map_get_cell_array(m, MAP_CELL_TRANSPARENT)
+
+def map_get_walkable_array(m):
+    return _map_get_cell_array(m, MAP_CELL_WALKABLE)
+
+# set every cell of the map at once from a string of cell bytes, the same
+# layout map_get_cells returns
+def map_set_cells(m, cells):
+    cmap = cast(c_void_p(m), POINTER(_CMap)).contents
+    if len(cells) != cmap.nbcells:
+        raise ValueError('expected %d cells, got %d' % (cmap.nbcells, len(cells)))
+    memmove(cmap.cells, cells, cmap.nbcells)
+
+# the bulk version of map_set_properties. transparent and walkable are height x
+# width arrays of bools if numpy is available, otherwise row-major sequences of
+# 0s and 1s. the fov bits are all cleared
+def map_set_properties_array(m, transparent, walkable):
+    if numpy_available:
+        cells = (numpy.asarray(transparent, dtype=numpy.uint8) * MAP_CELL_TRANSPARENT |
+            numpy.asarray(walkable, dtype=numpy.uint8) * MAP_CELL_WALKABLE)
+        cells = cells.astype(numpy.uint8).tobytes()
+    else:
+        cells = bytes(bytearray([(MAP_CELL_TRANSPARENT if t else 0) |
+            (MAP_CELL_WALKABLE if w else 0) for (t, w) in zip(transparent, walkable)]))
+    map_set_cells(m, cells)
+
 ############################
 # pathfinding module
 ############################
@@ -1779,6 +1837,26 @@ def bsp_traverse_inverted_level_order(node, callback, userData=0):
     _bsp_traverse(node, callback, userData,
                   _lib.TCOD_bsp_traverse_inverted_level_order)
 
+# every leaf under node as an (x, y, w, h) tuple, left to right. this walks the
+# tree structure straight from memory in one go, instead of having libtcod call
+# back into python for every node like the traversals do
+def bsp_leaves(node):
+    leaves = []
+    stack = [addressof(node.p.contents)]
+    while stack:
+        cnode = _CBsp.from_address(stack.pop())
+        if cnode.son:
+            # the sons are a linked list, push them so the first comes off first
+            sons = []
+            son = cnode.son
+            while son:
+                sons.append(son)
+                son = _CBsp.from_address(son).next
+            stack.extend(reversed(sons))
+        else:
+            leaves.append((cnode.x, cnode.y, cnode.w, cnode.h))
+    return leaves
+
 def bsp_remove_sons(node):
     _lib.TCOD_bsp_remove_sons(node.p)
 
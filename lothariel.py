@@ -26,6 +26,42 @@ import math
 # import wordwrap
 import textwrap
 
+# import numpy, used for the map planes
+import numpy
+
+# import OrderedDict, for the fov cache, and deque
+from collections import OrderedDict, deque
+
+# import heapq, for the turn scheduler
+import heapq
+
+# import random, for the headless random walk
+import random
+
+# import time and argparse, for running from the command line
+import time
+import argparse
+
+# import zlib, for turning the game seed into one seed per random stream
+import zlib
+
+# import json and timeit, for the frame timing trace
+import json
+import timeit
+
+# import gc and sys, for the memory report
+import gc
+import sys
+
+# import os, pickle, tempfile and shutil, for keeping old levels on disk
+import os
+import pickle
+import tempfile
+import shutil
+
+# import multiprocessing, for making the next level in the background
+import multiprocessing
+
 ###########################
 # Global Values 
 ########################### 
@@ -35,10 +71,35 @@ SCREEN_WIDTH = 80
 SCREEN_HEIGHT = 50
 LIMIT_FPS = 20
 
-# map size
+# map size, which can be a lot bigger than the screen
 MAP_WIDTH = 80
 MAP_HEIGHT = 43
 
+# the part of the screen the map is shown in. the camera scrolls the map
+# once the player gets within CAMERA_MARGIN of the edge of it
+VIEW_WIDTH = 80
+VIEW_HEIGHT = 43
+CAMERA_MARGIN = 10
+camera_x = 0
+camera_y = 0
+
+# the console the map is drawn on, made by init_console the size of the view,
+# or of the map if that's smaller. there isn't one when headless
+con = None
+
+# the map is kept in square chunks this wide, made when something is dug in them
+CHUNK_SIZE = 32
+
+# the fov, chase and path maps only cover the local area, LOCAL_SIZE square
+# around the player (or the whole map if it's smaller). it's moved to keep the
+# player at least LOCAL_MARGIN in from it's edges
+LOCAL_SIZE = 128
+LOCAL_MARGIN = 32
+local_x = 0
+local_y = 0
+local_width = MAP_WIDTH
+local_height = MAP_HEIGHT
+
 # GUI status bar things
 
 BAR_WIDTH = 20
@@ -56,17 +117,70 @@ ROOM_MAX_SIZE = 10
 ROOM_MIN_SIZE = 6
 MAX_ROOMS = 25
 
+# which map generator to use, 'rooms', 'bsp' or 'caves'. see MAP_GENERATORS
+MAP_GENERATOR = 'rooms'
+
+# the bsp generator splits the map BSP_DEPTH times at most, into pieces no
+# more than BSP_MAX_RATIO times longer than they're wide. BSP_ROOM_GAP is the
+# least room left around the room in each piece
+BSP_DEPTH = 16
+BSP_MAX_RATIO = 1.5
+BSP_ROOM_GAP = 1
+
+# the caves generator starts with CAVE_FILL of the map as wall, at random, then
+# smooths it CAVE_STEPS times: rock with at least CAVE_SURVIVE of it's 8
+# neighbours rock stays rock, and floor with at least CAVE_BIRTH turns to rock.
+# pockets of floor smaller than CAVE_MIN_POCKET are filled in and the rest
+# tunnelled together. for spawning and stairs the cave is cut into squares of
+# CAVE_AREA_SIZE, and those with at least CAVE_AREA_FLOOR of floor are used
+# like rooms
+CAVE_FILL = 0.5
+CAVE_STEPS = 4
+CAVE_SURVIVE = 4
+CAVE_BIRTH = 5
+CAVE_MIN_POCKET = 16
+CAVE_AREA_SIZE = 10
+CAVE_AREA_FLOOR = 0.25
+
+# a room that lands on another is moved to the nearest free spot up to this
+# far away, or failing that made as small as a room can be
+ROOM_RETRY_REACH = 5
+
 # FOV globals
 FOV_ALGO = libtcod.FOV_RESTRICTIVE
 FOV_LIGHT_WALLS = True
 TORCH_RADIUS = 10
 
+# how many computed fovs to keep around for when the player comes back to a spot
+FOV_CACHE_SIZE = 64
+
+# random number streams, each part of the game draws from it's own so they
+# don't shift each other's results. combat has no rolls yet but gets one ready
+RNG_STREAMS = ['mapgen', 'spawn', 'ai', 'combat']
+rngs = {}
+game_seed = None
+
+# frame timing, off unless turned on with F12 or --trace. the trace is saved
+# in chrome's trace event format, open it in chrome://tracing
+timing = False
+trace_file = 'lothariel_trace.json'
+trace_events = []
+trace_counters = []
+trace_clock = timeit.default_timer
+
+# when headless there is no window, and keys come from a script instead
+headless = False
+input_keys = iter([])
+
 # potion strength
 HEAL_AMOUNT = 8
 
 # damage globals
 LIGHTNING_DAMAGE = 15
 
+# lightning spell radius
+LIGHTNING_RADIUS = 2
+
 # monster constants
 MAX_ROOM_MONSTERS = 3
 
@@ -79,30 +193,234 @@ CONFUSE_NUM_TURNS = 7
 # confusion spell range
 CONFUSE_RANGE = 6
 
+# turn timing: how long an action takes at normal speed. something with speed
+# 200 acts twice for every action at speed 100, speed 50 half as often
+ACTION_COST = 100
+NORMAL_SPEED = 100
+
+# monster tracking: turns a monster keeps after the player once out of sight,
+# and how far the player can get from the end of a cached path before it's
+# worked out again
+TRACKING_TURNS = 20
+PATH_SLACK = 3
+
+# monster sleep: a monster with nothing to do dozes off once it's more than
+# SLEEP_RADIUS cells from the player, and stays out of the turn order until the
+# player comes within WAKE_RADIUS, into view, or makes a noise nearby
+SLEEP_RADIUS = 16
+WAKE_RADIUS = 6
+COMBAT_NOISE = 8
+LIGHTNING_NOISE = 12
+
+# how many levels to keep in memory, counting the one the player is on. the
+# rest are packed away to files until the player comes back to them
+LEVEL_CACHE_SIZE = 4
+
+# make the level below in a worker process while the player is on this one.
+# if the worker hasn't handed the level over within PREGENERATE_TIMEOUT
+# seconds of it being needed, or it failed, the level is made in the game
+# instead and the worker isn't used again
+PREGENERATE = True
+PREGENERATE_TIMEOUT = 10
+levels = None
+current_level = None
+
+# the libtcod maps for the current level, freed when the player leaves it
+fov_map = None
+chase_map = None
+path_pool = None
+
+# objects are also grouped into square sectors this wide, for finding
+# everything in an area
+SECTOR_SIZE = 8
+
+# the eight steps to neighbouring cells
+DIRECTIONS = [(-1, -1), (0, -1), (1, -1), (-1, 0), (1, 0), (-1, 1), (0, 1), (1, 1)]
+
 # map color definitions
 color_dark_wall = libtcod.Color(76, 26, 128)
 color_light_wall = libtcod.Color(153, 51, 255)
 color_dark_ground = libtcod.Color(92, 122, 153) 
 color_light_ground = libtcod.Color(153, 204, 255)
 
+# map backgrounds as a lookup table for render_all: unexplored, dark ground,
+# dark wall, light ground, light wall
+background_colors = [libtcod.black, color_dark_ground, color_dark_wall,
+    color_light_ground, color_light_wall]
+background_palette = numpy.array(
+    [(c.r, c.g, c.b) for c in background_colors], dtype=numpy.intc)
+
+# past this many changed cells it's cheaper to refill the whole map background
+# than to set the changed cells one at a time
+DIRTY_FILL_LIMIT = 400
+
 ################################
 # Classes
 ################################
 
 # map tile setup
-class Tile:
-    # a tile of the map and it's associated properties
-    def __init__(self, blocked, block_sight = None):
-        self.blocked = blocked
-        self.explored = False
-    
-        # by default, if a tile is blocked, it also blocks sight
-        if block_sight is None: block_sight = blocked
-        self.block_sight = block_sight
+class Tile(object):
+    # a view of one cell of the tile map and it's associated properties. the
+    # data itself lives in the TileMap planes, this just keeps map[x][y].blocked working
+    __slots__ = ('tiles', 'x', 'y')
+
+    def __init__(self, tiles, x, y):
+        self.tiles = tiles
+        self.x = x
+        self.y = y
+
+    def get_blocked(self):
+        return bool(self.tiles.blocked[self.y, self.x])
+    def set_blocked(self, value):
+        self.tiles.blocked[self.y, self.x] = value
+        self.tiles.revision += 1
+    blocked = property(get_blocked, set_blocked)
+
+    def get_block_sight(self):
+        return bool(self.tiles.block_sight[self.y, self.x])
+    def set_block_sight(self, value):
+        self.tiles.block_sight[self.y, self.x] = value
+        self.tiles.revision += 1
+    block_sight = property(get_block_sight, set_block_sight)
+
+    def get_explored(self):
+        return bool(self.tiles.explored[self.y, self.x])
+    def set_explored(self, value):
+        self.tiles.explored[self.y, self.x] = value
+    explored = property(get_explored, set_explored)
+
+# map storage
+class TileMap(object):
+    # the whole map as one plane per tile property instead of one object per
+    # tile. the planes are split into CHUNK_SIZE square chunks, only made once
+    # something in them is changed, so a big map only takes up memory where
+    # it's been dug. planes are indexed [y, x] (row-major) to match the render
+    # loop, see TilePlane. revision goes up on every change to blocked or
+    # block_sight, so anything worked out from the tiles can tell when it's out
+    # of date. change tiles through dig or a Tile so it gets counted
+    __slots__ = ('width', 'height', 'revision', 'chunks', 'blocked', 'block_sight', 'explored')
+
+    # every chunk holds all three planes, with these defaults: everything
+    # blocked, and so blocking sight as well, and nothing explored
+    DEFAULTS = (True, True, False)
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.revision = 0
+        self.chunks = {}
+
+        self.blocked = TilePlane(self, 0)
+        self.block_sight = TilePlane(self, 1)
+        self.explored = TilePlane(self, 2)
+
+    def new_chunk(self, cx, cy):
+        chunk = numpy.empty((3, CHUNK_SIZE, CHUNK_SIZE), dtype=bool)
+        for (plane, default) in enumerate(self.DEFAULTS):
+            chunk[plane] = default
+        self.chunks[(cx, cy)] = chunk
+        return chunk
+
+    # the chunks overlapping a rectangle, x2 and y2 exclusive, as (cx, cy, x1,
+    # y1, x2, y2) with the rectangle cut down to the part in that chunk
+    def chunk_spans(self, x1, y1, x2, y2):
+        for cy in range(y1 // CHUNK_SIZE, (y2 - 1) // CHUNK_SIZE + 1):
+            for cx in range(x1 // CHUNK_SIZE, (x2 - 1) // CHUNK_SIZE + 1):
+                yield (cx, cy,
+                    max(x1, cx * CHUNK_SIZE), max(y1, cy * CHUNK_SIZE),
+                    min(x2, (cx + 1) * CHUNK_SIZE), min(y2, (cy + 1) * CHUNK_SIZE))
+
+    # make the tiles in a rectangle passable, x2 and y2 are inclusive
+    def dig(self, x1, y1, x2, y2):
+        self.blocked[y1:y2 + 1, x1:x2 + 1] = False
+        self.block_sight[y1:y2 + 1, x1:x2 + 1] = False
+        self.revision += 1
+
+    # make the tiles passable where a plane of bools is true, and solid where
+    # it's false, with the plane's top left at (x, y)
+    def carve(self, x, y, floor):
+        (height, width) = floor.shape
+        self.blocked[y:y + height, x:x + width] = ~floor
+        self.block_sight[y:y + height, x:x + width] = ~floor
+        self.revision += 1
+
+    # old style access, map[x][y] gives a Tile view
+    def __getitem__(self, x):
+        return TileColumn(self, x)
+
+class TilePlane(object):
+    # one property of every tile on a TileMap. reads like a numpy plane: a
+    # single tile with plane[y, x], or a rectangle with plane[y1:y2, x1:x2]
+    # which comes back as a new array, and writes the same way. writing the
+    # default value into a chunk that hasn't been made doesn't make it
+    __slots__ = ('tiles', 'plane', 'default')
+
+    def __init__(self, tiles, plane):
+        self.tiles = tiles
+        self.plane = plane
+        self.default = tiles.DEFAULTS[plane]
+
+    # the rectangle a key covers, x2 and y2 exclusive
+    def bounds(self, key):
+        (y, x) = key
+        if not isinstance(y, slice):
+            return (x, y, x + 1, y + 1)
+        return (x.start or 0, y.start or 0,
+            self.tiles.width if x.stop is None else x.stop,
+            self.tiles.height if y.stop is None else y.stop)
+
+    def __getitem__(self, key):
+        (y, x) = key
+        if not isinstance(y, slice):
+            chunk = self.tiles.chunks.get((x // CHUNK_SIZE, y // CHUNK_SIZE))
+            if chunk is None:
+                return self.default
+            return chunk[self.plane, y % CHUNK_SIZE, x % CHUNK_SIZE]
+        return self.window(*self.bounds(key))
+
+    def __setitem__(self, key, value):
+        (x1, y1, x2, y2) = self.bounds(key)
+        value = numpy.asarray(value, dtype=bool)
+        for (cx, cy, sx1, sy1, sx2, sy2) in self.tiles.chunk_spans(x1, y1, x2, y2):
+            part = value
+            if value.ndim:
+                part = value[sy1 - y1:sy2 - y1, sx1 - x1:sx2 - x1]
+            chunk = self.tiles.chunks.get((cx, cy))
+            if chunk is None:
+                if not numpy.any(part != self.default):
+                    continue
+                chunk = self.tiles.new_chunk(cx, cy)
+            (ox, oy) = (cx * CHUNK_SIZE, cy * CHUNK_SIZE)
+            chunk[self.plane, sy1 - oy:sy2 - oy, sx1 - ox:sx2 - ox] = part
+
+    # a copy of the plane over a rectangle, x2 and y2 exclusive
+    def window(self, x1, y1, x2, y2):
+        out = numpy.empty((y2 - y1, x2 - x1), dtype=bool)
+        out[:] = self.default
+        for (cx, cy, sx1, sy1, sx2, sy2) in self.tiles.chunk_spans(x1, y1, x2, y2):
+            chunk = self.tiles.chunks.get((cx, cy))
+            if chunk is not None:
+                (ox, oy) = (cx * CHUNK_SIZE, cy * CHUNK_SIZE)
+                out[sy1 - y1:sy2 - y1, sx1 - x1:sx2 - x1] = chunk[self.plane,
+                    sy1 - oy:sy2 - oy, sx1 - ox:sx2 - ox]
+        return out
+
+class TileColumn(object):
+    # one column of the map, only here so map[x][y] still works
+    __slots__ = ('tiles', 'x')
+
+    def __init__(self, tiles, x):
+        self.tiles = tiles
+        self.x = x
+
+    def __getitem__(self, y):
+        return Tile(self.tiles, self.x, y)
 
 # room setup
-class Rect:
+class Rect(object):
     # a rectangle on the map, for making a room
+    __slots__ = ('x1', 'y1', 'x2', 'y2')
+
     def __init__(self, x, y, w, h):
         self.x1 = x
         self.y1 = y
@@ -110,8 +428,8 @@ class Rect:
         self.y2 = y + h
     
     def center(self):
-        center_x = (self.x1 + self.x2) / 2
-        center_y = (self.y1 + self.y2) / 2
+        center_x = (self.x1 + self.x2) // 2
+        center_y = (self.y1 + self.y2) // 2
         return (center_x, center_y)
 
     def intersect(self, other):
@@ -119,48 +437,386 @@ class Rect:
         return (self.x1 <= other.x2 and self.x2 >= other.x1 and
                 self.y1 <= other.y2 and self.y2 >= other.y1)
 
+# room placement
+class RoomGrid(object):
+    # which cells of the map are taken by rooms, so a new room can be checked
+    # against one patch of the grid instead of every room so far. rooms take
+    # up x2 and y2 as well, the same as Rect.intersect
+    __slots__ = ('taken',)
+
+    def __init__(self, width, height):
+        self.taken = numpy.zeros((height, width), dtype=bool)
+
+    def overlaps(self, rect):
+        return self.taken[rect.y1:rect.y2 + 1, rect.x1:rect.x2 + 1].any()
+
+    def add(self, rect):
+        self.taken[rect.y1:rect.y2 + 1, rect.x1:rect.x2 + 1] = True
+
+    # the free spot for a w by h room nearest to (x, y), at most reach away and
+    # inside the same bounds make_map keeps rooms in, or None if there isn't one
+    def nearest_free(self, x, y, w, h, reach):
+        (height, width) = self.taken.shape
+        (x1, y1) = (max(0, x - reach), max(0, y - reach))
+        (x2, y2) = (min(width - w - 1, x + reach), min(height - h - 1, y + reach))
+        if x2 < x1 or y2 < y1:
+            return None
+
+        # a summed area table over the patch, with a row and column of zeros in
+        # front, gives how many taken cells every possible room would cover
+        patch = self.taken[y1:y2 + h + 1, x1:x2 + w + 1]
+        sums = numpy.zeros((patch.shape[0] + 1, patch.shape[1] + 1), dtype=numpy.intc)
+        sums[1:, 1:] = patch.cumsum(0).cumsum(1)
+        covered = (sums[h + 1:, w + 1:] - sums[:-h - 1, w + 1:]
+            - sums[h + 1:, :-w - 1] + sums[:-h - 1, :-w - 1])
+
+        (ys, xs) = numpy.nonzero(covered == 0)
+        if len(xs) == 0:
+            return None
+        best = numpy.argmin((xs + x1 - x) ** 2 + (ys + y1 - y) ** 2)
+        return (int(xs[best]) + x1, int(ys[best]) + y1)
+
+# connectivity
+class LabelPlane(object):
+    # a number for every tile of a TileMap, or -1 for none, kept in chunks like
+    # the tiles so only the chunks with a number in take up memory. the numbers
+    # are int16 unless there are too many for that. reads like a TilePlane, a
+    # single tile with plane[y, x] or a rectangle with plane[y1:y2, x1:x2]
+    __slots__ = ('tiles', 'dtype', 'chunks')
+
+    def __init__(self, tiles, count):
+        self.tiles = tiles
+        self.dtype = numpy.int16 if count < 2 ** 15 else numpy.int32
+        self.chunks = {}
+
+    def __getitem__(self, key):
+        (y, x) = key
+        if not isinstance(y, slice):
+            chunk = self.chunks.get((x // CHUNK_SIZE, y // CHUNK_SIZE))
+            if chunk is None:
+                return -1
+            return int(chunk[y % CHUNK_SIZE, x % CHUNK_SIZE])
+        (x1, y1, x2, y2) = (x.start, y.start, x.stop, y.stop)
+        out = numpy.empty((y2 - y1, x2 - x1), dtype=self.dtype)
+        out[:] = -1
+        for (cx, cy, sx1, sy1, sx2, sy2) in self.tiles.chunk_spans(x1, y1, x2, y2):
+            chunk = self.chunks.get((cx, cy))
+            if chunk is not None:
+                (ox, oy) = (cx * CHUNK_SIZE, cy * CHUNK_SIZE)
+                out[sy1 - y1:sy2 - y1, sx1 - x1:sx2 - x1] = chunk[
+                    sy1 - oy:sy2 - oy, sx1 - ox:sx2 - ox]
+        return out
+
+    # copy in a plane of numbers over the whole map, leaving out the chunks
+    # with none
+    def fill(self, plane):
+        (height, width) = plane.shape
+        for (cx, cy, x1, y1, x2, y2) in self.tiles.chunk_spans(0, 0, width, height):
+            part = plane[y1:y2, x1:x2]
+            if numpy.any(part >= 0):
+                chunk = numpy.empty((CHUNK_SIZE, CHUNK_SIZE), dtype=self.dtype)
+                chunk[:] = -1
+                chunk[:y2 - y1, :x2 - x1] = part
+                self.chunks[(cx, cy)] = chunk
+
+class Regions(object):
+    # which floor is connected to which, worked out once when a level is made
+    # so nothing has to search the map for it later. labels has the number of
+    # the region of floor each cell is in, joined up 8 ways like the player
+    # moves, or -1 for walls, and sizes the cells in each region. rooms has the
+    # index of the room the inside of each room belongs to in rects, or -1
+    # elsewhere. both are LabelPlanes. neighbours has the rooms that can be
+    # reached from each room without going through another one
+    __slots__ = ('labels', 'sizes', 'rooms', 'rects', 'neighbours')
+
+    def __init__(self, labels, sizes, rooms, rects, neighbours):
+        self.labels = labels
+        self.sizes = sizes
+        self.rooms = rooms
+        self.rects = rects
+        self.neighbours = neighbours
+
+    def region_at(self, x, y):
+        return self.labels[y, x]
+
+    def room_at(self, x, y):
+        return self.rooms[y, x]
+
+    # the floor in a room nearest it's middle, for putting the stairs on
+    def spot(self, index):
+        rect = self.rects[index]
+        (x, y) = rect.center()
+        if self.rooms[y, x] == index:
+            return (x, y)
+        (ys, xs) = numpy.nonzero(self.rooms[rect.y1 + 1:rect.y2, rect.x1 + 1:rect.x2] == index)
+        (xs, ys) = (xs + rect.x1 + 1, ys + rect.y1 + 1)
+        nearest = numpy.argmin((xs - x) ** 2 + (ys - y) ** 2)
+        return (int(xs[nearest]), int(ys[nearest]))
+
+    # can (x1, y1) be walked to from (x2, y2)
+    def connected(self, x1, y1, x2, y2):
+        label = self.labels[y1, x1]
+        return label >= 0 and label == self.labels[y2, x2]
+
+    # the room the most rooms away from start, going from room to neighbouring
+    # room. the later room wins a tie
+    def farthest_room(self, start):
+        hops = {start: 0}
+        queue = deque([start])
+        while queue:
+            room = queue.popleft()
+            for other in self.neighbours[room]:
+                if other not in hops:
+                    hops[other] = hops[room] + 1
+                    queue.append(other)
+        return max(hops, key=lambda room: (hops[room], room))
+
+# entity storage
+class ComponentTable(object):
+    # one kind of component for every entity that has it, packed into a list
+    # so a system can run straight down it. slots maps entity -> list index,
+    # and removing swaps the last entry into the gap to keep the list dense
+    __slots__ = ('entities', 'components', 'slots')
+
+    def __init__(self):
+        self.entities = []
+        self.components = []
+        self.slots = {}
+
+    def __len__(self):
+        return len(self.entities)
+
+    def __contains__(self, eid):
+        return eid in self.slots
+
+    def get(self, eid):
+        slot = self.slots.get(eid)
+        if slot is None:
+            return None
+        return self.components[slot]
+
+    def add(self, eid, component):
+        slot = self.slots.get(eid)
+        if slot is not None:
+            self.components[slot] = component
+            return
+        self.slots[eid] = len(self.entities)
+        self.entities.append(eid)
+        self.components.append(component)
+
+    def remove(self, eid):
+        slot = self.slots.pop(eid, None)
+        if slot is None:
+            return
+        last_eid = self.entities.pop()
+        last = self.components.pop()
+        if last_eid != eid:
+            self.entities[slot] = last_eid
+            self.components[slot] = last
+            self.slots[last_eid] = slot
+
+class PositionTable(object):
+    # where every entity on the map is, as numpy arrays of x and y so systems
+    # can work on all the positions at once. dense the same way as ComponentTable
+    __slots__ = ('entities', 'slots', 'xs', 'ys')
+
+    def __init__(self):
+        self.entities = []
+        self.slots = {}
+        self.xs = numpy.zeros(64, dtype=numpy.intc)
+        self.ys = numpy.zeros(64, dtype=numpy.intc)
+
+    def __len__(self):
+        return len(self.entities)
+
+    def __contains__(self, eid):
+        return eid in self.slots
+
+    def add(self, eid, x, y):
+        slot = self.slots.get(eid)
+        if slot is None:
+            slot = len(self.entities)
+            if slot == len(self.xs):
+                # out of room, double the arrays
+                self.xs = numpy.concatenate((self.xs, numpy.zeros_like(self.xs)))
+                self.ys = numpy.concatenate((self.ys, numpy.zeros_like(self.ys)))
+            self.slots[eid] = slot
+            self.entities.append(eid)
+        self.xs[slot] = x
+        self.ys[slot] = y
+
+    def remove(self, eid):
+        slot = self.slots.pop(eid, None)
+        if slot is None:
+            return
+        last_eid = self.entities.pop()
+        last = len(self.entities)
+        if last_eid != eid:
+            self.entities[slot] = last_eid
+            self.xs[slot] = self.xs[last]
+            self.ys[slot] = self.ys[last]
+            self.slots[last_eid] = slot
+
+    # the x and y arrays, trimmed to the entities in the table
+    def arrays(self):
+        n = len(self.entities)
+        return (self.xs[:n], self.ys[:n])
+
+class World(object):
+    # every entity on a level, stored as dense component tables: position,
+    # glyph ([char, color, layer]), fighter, ai and item. objects maps each
+    # entity to the Object standing in front of it
+    __slots__ = ('next_eid', 'objects', 'position', 'glyph', 'fighter', 'ai', 'item')
+
+    def __init__(self):
+        self.next_eid = 0
+        self.objects = {}
+        self.position = PositionTable()
+        self.glyph = ComponentTable()
+        self.fighter = ComponentTable()
+        self.ai = ComponentTable()
+        self.item = ComponentTable()
+
+    def create(self, obj):
+        eid = self.next_eid
+        self.next_eid += 1
+        self.objects[eid] = obj
+        return eid
+
+    def destroy(self, eid):
+        for table in (self.position, self.glyph, self.fighter, self.ai, self.item):
+            table.remove(eid)
+        del self.objects[eid]
+
+    # add or replace a component, or take it away if component is None
+    def set_component(self, name, eid, component):
+        table = getattr(self, name)
+        if component is None:
+            table.remove(eid)
+        else:
+            table.add(eid, component)
+
+    # move an object and all it's components here from the world it's in
+    def adopt(self, obj):
+        old = obj.world
+        eid = obj.eid
+        position = None
+        if eid in old.position:
+            position = (obj.x, obj.y)
+        glyph = old.glyph.get(eid)
+        components = [(name, getattr(old, name).get(eid)) for name in ('fighter', 'ai', 'item')]
+        old.destroy(eid)
+
+        obj.world = self
+        obj.eid = self.create(obj)
+        if position is not None:
+            self.position.add(obj.eid, position[0], position[1])
+        self.glyph.add(obj.eid, glyph)
+        for (name, component) in components:
+            self.set_component(name, obj.eid, component)
+
+    # the objects whose entities have every one of the named components, found
+    # by running down the smallest of the tables
+    def query(self, *names):
+        tables = [getattr(self, name) for name in names]
+        smallest = min(tables, key=len)
+        return [self.objects[eid] for eid in list(smallest.entities)
+            if all(eid in table for table in tables)]
+
+# a property on Object that reads and writes one of it's components in the world
+def component_property(name):
+    def get_component(self):
+        return getattr(self.world, name).get(self.eid)
+    def set_component(self, component):
+        if component is not None:
+            component.owner = self
+        self.world.set_component(name, self.eid, component)
+    return property(get_component, set_component)
+
 # object setup
-class Object:
-    # this is a generic object, represented with a character
-    def __init__(self, x, y, char, name, color, blocks=False, fighter=None, ai=None, item=None):
+class Object(object):
+    # this is a generic object, represented with a character. the object itself
+    # only holds the name, blocking and speed, everything else is a component of
+    # it's entity in the world
+    __slots__ = ('world', 'eid', 'name', 'blocks', 'speed')
+
+    def __init__(self, x, y, char, name, color, blocks=False, fighter=None, ai=None, item=None,
+            speed=NORMAL_SPEED):
+        self.world = world
+        self.eid = world.create(self)
         self.name = name
         self.blocks = blocks
-        self.x = x
-        self.y = y
-        self.char = char
-        self.color = color
+        self.speed = speed
+
+        world.position.add(self.eid, x, y)
+        world.glyph.add(self.eid, [char, color, 1])
         
         self.item = item
-        if self.item:
-            self.item.owner = self
-        
         self.fighter = fighter
-        if self.fighter:
-            self.fighter.owner = self
-            
         self.ai = ai
-        if self.ai:
-            self.ai.owner = self
+
+    fighter = component_property('fighter')
+    ai = component_property('ai')
+    item = component_property('item')
+
+    def get_x(self):
+        table = self.world.position
+        return int(table.xs[table.slots[self.eid]])
+    def set_x(self, value):
+        table = self.world.position
+        table.xs[table.slots[self.eid]] = value
+    x = property(get_x, set_x)
+
+    def get_y(self):
+        table = self.world.position
+        return int(table.ys[table.slots[self.eid]])
+    def set_y(self, value):
+        table = self.world.position
+        table.ys[table.slots[self.eid]] = value
+    y = property(get_y, set_y)
+
+    def get_char(self):
+        return self.world.glyph.get(self.eid)[0]
+    def set_char(self, value):
+        self.world.glyph.get(self.eid)[0] = value
+    char = property(get_char, set_char)
+
+    def get_color(self):
+        return self.world.glyph.get(self.eid)[1]
+    def set_color(self, value):
+        self.world.glyph.get(self.eid)[1] = value
+    color = property(get_color, set_color)
         
     # moves the object by the given amount
     def move(self, dx, dy):
         if not is_blocked(self.x + dx, self.y + dy):
-            self.x += dx
-            self.y += dy
+            object_index.move(self, self.x + dx, self.y + dy)
             
-    # move towards a target
-    def move_towards(self, target_x, target_y):
-        # vector from this object to the target, and distance
-        dx = target_x - self.x
-        dy = target_y - self.y
-        distance = math.sqrt(dx ** 2 + dy ** 2)
-        
-        # normalize it to length 1 (preserving direction), then round it and
-        # convert to int so the movement is restricted to the map grid
-        dx = int(round(dx / distance))
-        dy = int(round(dy / distance))
-        self.move(dx, dy)
-        
+    # take a step down the chase map, to whichever free neighbouring cell is
+    # closest to the player
+    def chase(self):
+        if not in_local_area(self.x, self.y):
+            return
+        best_distance = libtcod.dijkstra_get_distance(chase_map, self.x - local_x, self.y - local_y)
+        best_step = None
+        for (dx, dy) in DIRECTIONS:
+            (x, y) = (self.x + dx, self.y + dy)
+            if in_local_area(x, y):
+                distance = libtcod.dijkstra_get_distance(chase_map, x - local_x, y - local_y)
+                if 0 <= distance < best_distance and not is_blocked(x, y):
+                    best_distance = distance
+                    best_step = (dx, dy)
+        if best_step is not None:
+            self.move(*best_step)
+
+    # how long one action takes this object
+    def action_time(self):
+        return ACTION_COST * NORMAL_SPEED // self.speed
+
+    # is the other object on one of the eight cells around this one
+    def is_next_to(self, other):
+        return abs(other.x - self.x) <= 1 and abs(other.y - self.y) <= 1
+
     # find distance
     def distance_to(self, other):
         # return the distance to another object
@@ -168,25 +824,22 @@ class Object:
         dy = other.y - self.y
         return math.sqrt(dx ** 2 + dy ** 2)
     
-    # set the color and draw the character representing the object on screen
+    # set the color and draw the character representing the object on screen,
+    # where the camera puts it
     def draw(self):
-        if libtcod.map_is_in_fov(fov_map, self.x, self.y):
-            libtcod.console_set_default_foreground(con, self.color)
-            libtcod.console_put_char(con, self.x, self.y, self.char, libtcod.BKGND_NONE)
-        
-    # erase the character representing this object
-    def clear(self):
-        libtcod.console_put_char(con, self.x, self.y, ' ', libtcod.BKGND_NONE)
+        libtcod.console_set_default_foreground(con, self.color)
+        libtcod.console_put_char(con, self.x - camera_x, self.y - camera_y, self.char,
+            libtcod.BKGND_NONE)
 
-    # move to the start of the object list, forcing it to be drawn first (below other stuff)
+    # move to the bottom layer, forcing it to be drawn first (below other stuff)
     def send_to_back(self):
-        global objects
-        objects.remove(self)
-        objects.insert(0, self)
+        self.world.glyph.get(self.eid)[2] = 0
         
 # fighter class
-class Fighter:
+class Fighter(object):
     # combat related properties and methods 
+    __slots__ = ('owner', 'max_hp', 'hp', 'defense', 'power', 'death_function')
+
     def __init__(self, hp, defense, power, death_function=None):
         self.max_hp = hp
         self.hp = hp
@@ -207,6 +860,9 @@ class Fighter:
     def attack(self, target):
         # a simple formula for attack damage
         damage = self.power - target.fighter.defense
+
+        # fighting is loud
+        make_noise(self.owner.x, self.owner.y, COMBAT_NOISE)
         
         if damage > 0:
             # target takes damage
@@ -226,22 +882,54 @@ class Fighter:
             self.hp = self.max_hp
             
 # basic monster ai
-class BasicMonster:
+class BasicMonster(object):
+    __slots__ = ('owner', 'path', 'tracking', 'asleep')
+
+    def __init__(self):
+        # the path is only made once the monster starts tracking the player
+        self.path = None
+        self.tracking = 0
+
+        # monsters start asleep, and wake when the player comes near
+        self.asleep = True
+
     def take_turn(self):
         # monster takes it's turn. if you can see if, it can see you.
         monster = self.owner
-        if libtcod.map_is_in_fov(fov_map, monster.x, monster.y):
+        if is_visible(monster.x, monster.y):
+            # it will keep after the player for a while once out of sight
+            self.tracking = TRACKING_TURNS
+            if self.path is None:
+                self.path = CachedPath()
         
             # move towards the player
-            if monster.distance_to(player) >= 2:
-                monster.move_towards(player.x, player.y)
+            if not monster.is_next_to(player):
+                monster.chase()
                 
             # within attack range
             elif player.fighter.hp > 0:
                 monster.fighter.attack(player)
+
+        elif self.tracking > 0:
+            # lost sight of the player, follow where they went
+            self.tracking -= 1
+            if not monster.is_next_to(player):
+                self.path.walk(monster, player)
+            elif player.fighter.hp > 0:
+                monster.fighter.attack(player)
+
+        elif max(abs(player.x - monster.x), abs(player.y - monster.y)) > SLEEP_RADIUS:
+            # nothing to do and nobody about, doze off
+            self.asleep = True
+            self.path = None
                 
 # confused monster ai
-class ConfusedMonster:
+class ConfusedMonster(object):
+    __slots__ = ('owner', 'old_ai', 'num_turns')
+
+    # too confused to sleep
+    asleep = False
+
     def __init__(self, old_ai, num_turns=CONFUSE_NUM_TURNS):
         # monster will be confused temporarily. each turn will take a step towards original ai
         self.old_ai = old_ai
@@ -252,7 +940,7 @@ class ConfusedMonster:
         
         # if still confused
         if self.num_turns > 0:
-            self.owner.move(libtcod.random_get_int(0, -1, 1), libtcod.random_get_int(0, -1, 1))
+            self.owner.move(libtcod.random_get_int(rngs['ai'], -1, 1), libtcod.random_get_int(rngs['ai'], -1, 1))
             self.num_turns -= 10
         
         # no longer confused
@@ -261,7 +949,9 @@ class ConfusedMonster:
             message('The ' + self.owner.name + ' is no longer confused!', libtcod.red)
                 
 # item
-class Item:
+class Item(object):
+    __slots__ = ('owner', 'use_function')
+
     def __init__(self, use_function=None):
         self.use_function = use_function
     def use(self):
@@ -271,6 +961,7 @@ class Item:
         else:
             if self.use_function() != 'cancelled':
                 inventory.remove(self.owner) # destroy if used, unless cancelled
+                self.owner.world.destroy(self.owner.eid)
                 
     def pick_up(self):
         # add to player's inventory and remove from the map
@@ -278,48 +969,559 @@ class Item:
             message('Your inventory is full, cannot pick up ' + self.owner.name + '.', libtcod.blue)
         else:
             inventory.append(self.owner)
-            objects.remove(self.owner)
+            remove_object(self.owner)
             message('You picked up a ' + self.owner.name + '!', libtcod.green)
             
+# object lookup
+class SpatialIndex:
+    # keeps track of which objects are on each cell, so finding what is at a
+    # spot doesn't need a scan of the whole objects list. objects are also kept
+    # by sector, for finding everything in an area
+    def __init__(self):
+        self.cells = {}
+        self.sectors = {}
+
+    def add(self, obj):
+        self.cells.setdefault((obj.x, obj.y), []).append(obj)
+        sector = (obj.x // SECTOR_SIZE, obj.y // SECTOR_SIZE)
+        self.sectors.setdefault(sector, []).append(obj)
+
+    def remove(self, obj):
+        cell = self.cells[(obj.x, obj.y)]
+        cell.remove(obj)
+        if not cell:
+            del self.cells[(obj.x, obj.y)]
+        sector = (obj.x // SECTOR_SIZE, obj.y // SECTOR_SIZE)
+        self.sectors[sector].remove(obj)
+        if not self.sectors[sector]:
+            del self.sectors[sector]
+
+    # move an object to a new cell, keeping the index up to date
+    def move(self, obj, x, y):
+        self.remove(obj)
+        obj.x = x
+        obj.y = y
+        self.add(obj)
+
+    # all the objects in the sectors a rectangle overlaps, some of them
+    # outside it. x2 and y2 are inclusive
+    def in_sectors(self, x1, y1, x2, y2):
+        found = []
+        for sy in range(y1 // SECTOR_SIZE, y2 // SECTOR_SIZE + 1):
+            for sx in range(x1 // SECTOR_SIZE, x2 // SECTOR_SIZE + 1):
+                found.extend(self.sectors.get((sx, sy), ()))
+        return found
+
+    # all the objects inside a rectangle, x2 and y2 are inclusive
+    def in_rect(self, x1, y1, x2, y2):
+        return [obj for obj in self.in_sectors(x1, y1, x2, y2)
+            if x1 <= obj.x <= x2 and y1 <= obj.y <= y2]
+
+    # all the objects within radius of (x, y), as (squared distance, object)
+    # pairs. only the sectors overlapping the circle are looked at
+    def in_radius(self, x, y, radius):
+        found = []
+        r2 = radius * radius
+        for sy in range((y - radius) // SECTOR_SIZE, (y + radius) // SECTOR_SIZE + 1):
+            for sx in range((x - radius) // SECTOR_SIZE, (x + radius) // SECTOR_SIZE + 1):
+                for obj in self.sectors.get((sx, sy), ()):
+                    dx = obj.x - x
+                    dy = obj.y - y
+                    d2 = dx * dx + dy * dy
+                    if d2 <= r2:
+                        found.append((d2, obj))
+        return found
+
+    # all the objects at (x, y), in the order they arrived there
+    def at(self, x, y):
+        return self.cells.get((x, y), ())
+
+    # the object blocking (x, y), if any
+    def blocker_at(self, x, y):
+        for obj in self.cells.get((x, y), ()):
+            if obj.blocks:
+                return obj
+        return None
+
+# turn scheduling
+class Scheduler:
+    # the actors waiting for their next turn, as a heap ordered by the time
+    # they act, so only the ones that are due get looked at. actors that lose
+    # their ai (by dying) or fall asleep are dropped when they come up
+    def __init__(self):
+        self.queue = []
+        self.time = 0
+        self.count = 0
+
+    # obj acts again after delay
+    def schedule(self, obj, delay):
+        # the count keeps actors due at the same time in the order they were added
+        self.count += 1
+        heapq.heappush(self.queue, (self.time + delay, self.count, obj))
+
+    # give every actor due up to time it's turns, in order
+    def run_until(self, time):
+        while self.queue and self.queue[0][0] <= time:
+            (self.time, count, obj) = heapq.heappop(self.queue)
+            if obj.ai is None or obj.ai.asleep:
+                continue
+            obj.ai.take_turn()
+            if obj.ai is not None and not obj.ai.asleep:
+                self.schedule(obj, obj.action_time())
+        self.time = time
+
+# pathfinding
+class PathPool:
+    # libtcod path objects to reuse instead of allocating one per path. they all
+    # work over the pool's own copy of the fov map, so blockers can be marked on
+    # it while a path is computed. like the fov map it only covers the local
+    # area, and the copy is made again when that moves or the tiles change
+    def __init__(self):
+        self.map = libtcod.map_new(local_width, local_height)
+        self.revision = None
+        self.free = []
+
+    # work out a path from (ox, oy) to (dx, dy) going round the cells in avoid,
+    # and return the steps along it, or an empty list if there's no way through
+    # or either end is outside the local area
+    def compute(self, ox, oy, dx, dy, avoid=()):
+        if not (in_local_area(ox, oy) and in_local_area(dx, dy)):
+            return []
+        revision = (map.revision, local_x, local_y)
+        if self.revision != revision:
+            libtcod.map_copy(fov_map, self.map)
+            self.revision = revision
+
+        if self.free:
+            path = self.free.pop()
+        else:
+            path = libtcod.path_new_using_map(self.map)
+
+        avoid = [(x, y) for (x, y) in avoid if in_local_area(x, y)]
+        for (x, y) in avoid:
+            libtcod.map_set_properties(self.map, x - local_x, y - local_y,
+                not map.block_sight[y, x], False)
+        steps = []
+        if libtcod.path_compute(path, ox - local_x, oy - local_y, dx - local_x, dy - local_y):
+            for i in range(libtcod.path_size(path)):
+                (x, y) = libtcod.path_get(path, i)
+                steps.append((x + local_x, y + local_y))
+        for (x, y) in avoid:
+            libtcod.map_set_properties(self.map, x - local_x, y - local_y,
+                not map.block_sight[y, x], not map.blocked[y, x])
+
+        self.free.append(path)
+        return steps
+
+    def delete(self):
+        for path in self.free:
+            libtcod.path_delete(path)
+        libtcod.map_delete(self.map)
+
+class CachedPath(object):
+    # a path to a moving target, worked out once and walked over several turns.
+    # it's only computed again when the target gets PATH_SLACK cells away from
+    # the end of it, a tile on it changes, or something blocks the way
+    __slots__ = ('steps', 'target', 'revision')
+
+    def __init__(self):
+        self.steps = []
+        self.target = None
+        self.revision = None
+
+    def is_stale(self, target):
+        if self.target is None:
+            return True
+
+        # the target has wandered off from where the path ends
+        (tx, ty) = self.target
+        if max(abs(target.x - tx), abs(target.y - ty)) > PATH_SLACK:
+            return True
+
+        # the map changed under the path
+        if self.revision != map.revision:
+            for (x, y) in self.steps:
+                if map.blocked[y, x]:
+                    return True
+            self.revision = map.revision
+
+        return False
+
+    # take the next step along the path towards target
+    def walk(self, owner, target):
+        avoid = ()
+        if not self.is_stale(target) and self.steps:
+            (x, y) = self.steps[0]
+            blocker = object_index.blocker_at(x, y)
+            if blocker is None or blocker is target:
+                self.take_step(owner)
+                return
+            # something is in the way, go round it
+            avoid = [(x, y)]
+
+        self.steps = path_pool.compute(owner.x, owner.y, target.x, target.y, avoid)
+        self.target = (target.x, target.y)
+        self.revision = map.revision
+        if self.steps and not is_blocked(*self.steps[0]):
+            self.take_step(owner)
+
+    def take_step(self, owner):
+        (x, y) = self.steps.pop(0)
+        if max(abs(x - owner.x), abs(y - owner.y)) == 1:
+            owner.move(x - owner.x, y - owner.y)
+        else:
+            # knocked off the path somehow, start again next turn
+            self.target = None
+
+# fov cache
+class FovCache:
+    # recently computed fovs, packed down to a bit per cell and keyed by
+    # everything the result depends on. the least recently used goes first
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        packed = self.entries.pop(key, None)
+        if packed is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries[key] = packed
+        (shape, bits) = packed
+        return numpy.unpackbits(bits)[:shape[0] * shape[1]].reshape(shape).astype(bool)
+
+    def put(self, key, visible):
+        self.entries[key] = (visible.shape, numpy.packbits(visible))
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+fov_cache = FovCache(FOV_CACHE_SIZE)
+
+# dungeon levels
+class Level(object):
+    # one floor of the dungeon: it's tiles and the world of things on it. the
+    # player and their inventory aren't part of it, they go with the player.
+    # up_stairs is where the player arrives from above (the start of the game
+    # on the first level, which has no stairs up) and down_stairs where they
+    # arrive from below. regions is how it's floor joins up
+    __slots__ = ('depth', 'map', 'world', 'up_stairs', 'down_stairs', 'regions')
+
+    def __init__(self, depth, map, world, up_stairs, down_stairs, regions):
+        self.depth = depth
+        self.map = map
+        self.world = world
+        self.up_stairs = up_stairs
+        self.down_stairs = down_stairs
+        self.regions = regions
+
+class LevelManager(object):
+    # the levels of the dungeon by depth. the size most recently visited stay in
+    # memory, the one the player is on always among them. older ones are packed
+    # into files in a temporary directory, and unpacked again when the player
+    # goes back, so memory stays the same however deep the player goes. levels
+    # can also be made ahead of time by a worker process, see pregenerate
+    __slots__ = ('size', 'levels', 'files', 'directory', 'pool', 'pending',
+        'loads', 'spills', 'pregenerated', 'worker_failed')
+
+    def __init__(self, size):
+        # the level being left has to stay in memory while the next is fetched
+        self.size = max(size, 2)
+        self.levels = OrderedDict()
+        self.files = {}
+        self.directory = None
+        self.pool = None
+        self.pending = {}
+        self.loads = 0
+        self.spills = 0
+        self.pregenerated = 0
+        self.worker_failed = False
+
+    # the level at depth, from memory, from disk, from the worker or newly made
+    def get(self, depth):
+        level = self.levels.pop(depth, None)
+        if level is None and depth in self.files:
+            path = self.files.pop(depth)
+            with open(path, 'rb') as f:
+                level = unpack_level(read_record(f))
+            os.remove(path)
+            self.loads += 1
+        if level is None and depth in self.pending:
+            # if the worker isn't done yet it's still the quickest way, unless
+            # it's stuck or broken
+            try:
+                level = unpack_level(self.pending.pop(depth).get(PREGENERATE_TIMEOUT))
+                self.pregenerated += 1
+            except Exception:
+                self.worker_failed = True
+                self.stop_worker()
+        if level is None:
+            level = generate_level(depth)
+        self.levels[depth] = level
+
+        while len(self.levels) > self.size:
+            self.spill(*self.levels.popitem(last=False))
+        return level
+
+    # start making the level at depth in the worker, unless it's already made
+    # or on the way. it comes from the same seed so it's the same level
+    # generate_level would make
+    def pregenerate(self, depth):
+        if depth in self.levels or depth in self.files or depth in self.pending:
+            return
+        if self.worker_failed:
+            return
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(1)
+        settings = (MAP_WIDTH, MAP_HEIGHT, MAX_ROOMS, MAX_ROOM_MONSTERS, MAX_ROOM_ITEMS,
+            MAP_GENERATOR)
+        self.pending[depth] = self.pool.apply_async(level_record,
+            (game_seed, depth, settings))
+
+    def spill(self, depth, level):
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix='lothariel-')
+        path = os.path.join(self.directory, 'level%d.dat' % depth)
+        with open(path, 'wb') as f:
+            write_record(f, pack_level(level))
+        self.files[depth] = path
+        self.spills += 1
+
+    # stop the worker, dropping any levels it was making
+    def stop_worker(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        self.pending.clear()
+
+    # throw away every level, including the files, and stop the worker
+    def close(self):
+        self.stop_worker()
+        self.levels.clear()
+        self.files.clear()
+        if self.directory is not None:
+            shutil.rmtree(self.directory, True)
+            self.directory = None
+
+# random streams
+class RngBackup(object):
+    # a copy of the state of every random stream, to put them back to later.
+    # each copy is a libtcod generator of it's own, so delete the backup once
+    # done with it
+    __slots__ = ('copies',)
+
+    def __init__(self):
+        self.copies = dict((name, libtcod.random_save(rng)) for (name, rng) in rngs.items())
+
+    def restore(self):
+        for (name, copy) in self.copies.items():
+            libtcod.random_restore(rngs[name], copy)
+
+    def delete(self):
+        for copy in self.copies.values():
+            libtcod.random_delete(copy)
+        self.copies = {}
+
+# frame timing
+class Span:
+    # times the code inside a with block while frame timing is on
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = trace_clock()
+
+    def __exit__(self, *exc_info):
+        add_span(self.name, self.start)
+
+class NoSpan:
+    # stands in for Span while timing is off, so it costs next to nothing
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+no_span = NoSpan()
+
 ###################################
 # Functions
 ###################################
 
+# a timer for one phase of the frame, use as "with span('name'):"
+def span(name):
+    if timing:
+        return Span(name)
+    return no_span
+
+# record a phase that started at start and ends now
+def add_span(name, start):
+    if timing:
+        trace_events.append((name, start, trace_clock() - start))
+
+# record a count as it stands now, shown as a graph along the timeline
+def add_counter(name, value):
+    if timing:
+        trace_counters.append((name, trace_clock(), value))
+
+def start_timing():
+    global timing, trace_events, trace_counters
+    timing = True
+    trace_events = []
+    trace_counters = []
+    message('Frame timing on.', libtcod.light_gray)
+
+# stop timing and save what was recorded as a trace event timeline
+def stop_timing():
+    global timing
+    timing = False
+    if not trace_events:
+        return
+    origin = trace_events[0][1]
+    events = [{'name': name, 'cat': 'frame', 'ph': 'X', 'pid': 1, 'tid': 1,
+        'ts': (start - origin) * 1000000, 'dur': duration * 1000000}
+        for (name, start, duration) in trace_events]
+    events.extend({'name': name, 'cat': 'frame', 'ph': 'C', 'pid': 1,
+        'ts': (at - origin) * 1000000, 'args': {name: value}}
+        for (name, at, value) in trace_counters)
+    with open(trace_file, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    message('Frame timing saved to ' + trace_file + '.', libtcod.light_gray)
+
+# the game's own types, counted by the memory report. they have to be new
+# style classes, type() of anything else is just instance in python 2
+def memory_types():
+    return (Object, Fighter, Item, BasicMonster, ConfusedMonster, CachedPath, Rect,
+        Tile, TileColumn, TileMap, World, ComponentTable, PositionTable, Level)
+
+# count the live instances of each game type and the bytes they take up. the
+# bytes are the instances themselves plus any __dict__, not what they point to
+def memory_report():
+    types = memory_types()
+    counts = dict((cls, [0, 0]) for cls in types)
+    gc.collect()
+    for obj in gc.get_objects():
+        entry = counts.get(type(obj))
+        if entry is None:
+            continue
+        entry[0] += 1
+        entry[1] += sys.getsizeof(obj)
+        if hasattr(obj, '__dict__'):
+            entry[1] += sys.getsizeof(obj.__dict__)
+    return [(cls.__name__, counts[cls][0], counts[cls][1]) for cls in types
+        if counts[cls][0]]
+
+def print_memory_report():
+    total = 0
+    for (name, count, size) in memory_report():
+        print('%-16s %6d %10d bytes' % (name, count, size))
+        total += size
+    print('%-16s %6s %10d bytes' % ('total', '', total))
+
+# the seed for one random stream. the first level uses the streams as seeded at
+# the start, deeper levels get their own so each is the same whatever order
+# the player visits them in
+def stream_seed(seed, name, depth=1):
+    if depth == 1:
+        text = '%d:%s' % (seed, name)
+    else:
+        text = '%d:%d:%s' % (seed, depth, name)
+    return zlib.crc32(text.encode('ascii')) & 0xffffffff
+
+def seed_stream(name, seed, depth=1):
+    if name in rngs:
+        libtcod.random_delete(rngs[name])
+    rngs[name] = libtcod.random_new_from_seed(stream_seed(seed, name, depth))
+
+# seed every random stream from the one game seed, the same seed always gives
+# the same dungeon
+def seed_rngs(seed):
+    global game_seed
+    game_seed = seed
+    for name in RNG_STREAMS:
+        seed_stream(name, seed)
+
+# seed the map and spawn streams for making the level at depth
+def seed_level_rngs(depth):
+    seed_stream('mapgen', game_seed, depth)
+    seed_stream('spawn', game_seed, depth)
+
+# take a copy of the state of every random stream, see RngBackup
+def save_rngs():
+    return RngBackup()
+
+# put a new object into the game
+def add_object(obj):
+    object_index.add(obj)
+    if obj.ai and not obj.ai.asleep:
+        scheduler.schedule(obj, obj.action_time())
+
+# wake a sleeping monster, putting it back in the turn order
+def wake_monster(monster):
+    monster.ai.asleep = False
+    scheduler.schedule(monster, monster.action_time())
+
+# can (x2, y2) be walked to from (x1, y1) on the current level
+def reachable(x1, y1, x2, y2):
+    if current_level is None:
+        return True
+    return current_level.regions.connected(x1, y1, x2, y2)
+
+# wake the sleeping monsters the player has come near to or into view of. being
+# near only counts if the monster could get to the player
+def wake_monsters():
+    r = max(WAKE_RADIUS, TORCH_RADIUS)
+    for object in object_index.in_rect(player.x - r, player.y - r, player.x + r, player.y + r):
+        if object.ai and object.ai.asleep:
+            near = (max(abs(player.x - object.x), abs(player.y - object.y)) <= WAKE_RADIUS and
+                reachable(player.x, player.y, object.x, object.y))
+            if near or is_visible(object.x, object.y):
+                wake_monster(object)
+
+# a noise at (x, y) wakes any sleeping monster within radius that could get to it
+def make_noise(x, y, radius):
+    for object in object_index.in_rect(x - radius, y - radius, x + radius, y + radius):
+        if (object.ai and object.ai.asleep and
+                (object.x - x) ** 2 + (object.y - y) ** 2 <= radius ** 2 and
+                reachable(x, y, object.x, object.y)):
+            wake_monster(object)
+
+# take an object off the map. it keeps it's other components, so an item can
+# still be used from the inventory
+def remove_object(obj):
+    object_index.remove(obj)
+    world.position.remove(obj.eid)
+
 # test for blocks
 def is_blocked(x, y):
     # test the map tile
-    if map[x][y].blocked:
+    if map.blocked[y, x]:
         return True
         
     # test for blocking objects
-    for object in objects:
-        if object.blocks and object.x == x and object.y == y:
-            return True
-            
-    return False
+    return object_index.blocker_at(x, y) is not None
 
         
 # map init
 def create_room(room):
     global map
-    # go through the tiles in a rectangle and make them passable
-    for x in range(room.x1 + 1, room.x2):
-        for y in range(room.y1 + 1, room.y2):
-            map[x][y].blocked = False
-            map[x][y].block_sight = False
+    # make the tiles inside the rectangle passable, leaving the walls on the edge
+    map.dig(room.x1 + 1, room.y1 + 1, room.x2 - 1, room.y2 - 1)
         
 # tunnel builder
 def create_h_tunnel(x1, x2, y):
     global map
-    for x in range(min(x1, x2), max(x1, x2) +1):
-        map[x][y].blocked = False
-        map[x][y].block_sight = False
+    map.dig(min(x1, x2), y, max(x1, x2), y)
     
 def create_v_tunnel(y1, y2, x):
     global map
-    for y in range(min(y1, y2), max(y1, y2) +1):
-        map[x][y].blocked = False
-        map[x][y].block_sight = False
+    map.dig(x, min(y1, y2), x, max(y1, y2))
 
 # heal the player
 def cast_heal():
@@ -339,109 +1541,350 @@ def max_heal():
     message('Your wounds are healed!', libtcod.violet)
     player.fighter.hp = player.fighter.max_hp
 
+# targeting
+# every fighter other than the player within radius of (x, y), nearest first.
+# with in_fov only the ones the player can see. distances are squared, so
+# there's no sqrt, and only the nearby sectors of the index are searched
+def fighters_in_radius(x, y, radius, in_fov=True):
+    found = [(d2, obj.eid, obj) for (d2, obj) in object_index.in_radius(x, y, radius)
+        if obj.fighter and obj != player and (not in_fov or is_visible(obj.x, obj.y))]
+    found.sort()
+    return [obj for (d2, eid, obj) in found]
+
+# the k nearest fighters to (x, y) other than the player, no further away than
+# max_range
+def nearest_fighters(x, y, k=1, max_range=TORCH_RADIUS, in_fov=True):
+    return fighters_in_radius(x, y, max_range, in_fov)[:k]
+
 # attack that will damage all enemies in radius of 2 from player    
 def cast_lightning():
     message('A large blast of lightning appears!', libtcod.yellow)
-    for object in objects:
-        if object.fighter and not object == player and libtcod.map_is_in_fov(fov_map, object.x, object.y):
-            dist = player.distance_to(object)
-            if dist <= 2:
-                # print the message about damage first, as if it kills the monster it will tell us the corpse has taken damage...
-                message(object.name.capitalize() + ' takes ' + str(LIGHTNING_DAMAGE) + ' points of lightning damage!', libtcod.red)
-                object.fighter.take_damage(LIGHTNING_DAMAGE)
+    make_noise(player.x, player.y, LIGHTNING_NOISE)
+    for object in fighters_in_radius(player.x, player.y, LIGHTNING_RADIUS):
+        # print the message about damage first, as if it kills the monster it will tell us the corpse has taken damage...
+        message(object.name.capitalize() + ' takes ' + str(LIGHTNING_DAMAGE) + ' points of lightning damage!', libtcod.red)
+        object.fighter.take_damage(LIGHTNING_DAMAGE)
                 
                 
 # attack that will confuse the enemy
 def cast_confuse():
     # find the nearest enemy and confuse it
-    for object in objects:
-        if object.fighter and not object == player and libtcod.map_is_in_fov(fov_map, object.x, object.y):
-            dist = player.distance_to(object)
-            if dist <= 6:        
-                # replace the monster's normal ai with the confused ai
-                monster = object.fighter
-                old_ai = monster.ai
-                monster.ai = ConfusedMonster(old_ai)
-                monster.ai.owner = monster
-                message('The ' + monster.name + ' seems unsure of what is happening!', libtcod.light_green)
-                
-    
+    targets = nearest_fighters(player.x, player.y, 1, CONFUSE_RANGE)
+    if not targets:
+        message('No enemy is close enough to confuse.', libtcod.red)
+        return 'cancelled'
+    monster = targets[0]
+
+    # a monster in view can still be asleep, and then it's not in the turn
+    # order. wake it first, nothing wakes a confused monster
+    if monster.ai.asleep:
+        wake_monster(monster)
+
+    # replace the monster's normal ai with the confused ai
+    monster.ai = ConfusedMonster(monster.ai)
+    message('The ' + monster.name + ' seems unsure of what is happening!', libtcod.light_green)
         
+# make a new map full of monsters and items with the generator MAP_GENERATOR
+# names, and return the rooms in the order they were dug, each joined to the
+# one before
 def make_map():
-    global map, player
+    global map
     
     # fill map with blocked tiles
-    map = [[Tile(True)
-        for y in range(MAP_HEIGHT) ]
-            for x in range(MAP_WIDTH) ]
-            
+    map = TileMap(MAP_WIDTH, MAP_HEIGHT)
+
+    return MAP_GENERATORS[MAP_GENERATOR]()
+
+# dig out a room, fill it, and join it to the last of the rooms so far
+def add_room(rooms, new_room):
+    # draw the room
+    create_room(new_room)
+    
+    # add objects to the room
+    place_objects(new_room)
+
+    # get the center coordinates
+    (new_x, new_y) = new_room.center()
+
+    if rooms:
+        # for all rooms after the first, make a tunnel from the previous room
+        # using the center coordinates of the previous room
+        (prev_x, prev_y) = rooms[-1].center()
+
+        # flip a coin
+        if libtcod.random_get_int(rngs['mapgen'], 0, 1) == 1:
+            # horizontal first, vertical second
+            create_h_tunnel(prev_x, new_x, prev_y)
+            create_v_tunnel(prev_y, new_y, new_x)
+        
+        else:
+            # vertical first, horizontal second
+            create_v_tunnel(prev_y, new_y, prev_x)
+            create_h_tunnel(prev_x, new_x, new_y)
+   
+    # append the new room to the list
+    rooms.append(new_room)
+
+# the rooms generator: MAX_ROOMS rooms of random sizes dropped at random,
+# moved out of each other's way
+def make_random_rooms():
     rooms = []
-    num_rooms = 0
+    grid = RoomGrid(MAP_WIDTH, MAP_HEIGHT)
     
     for r in range(MAX_ROOMS):
         # random width and height
-        w = libtcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
-        h = libtcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+        w = libtcod.random_get_int(rngs['mapgen'], ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+        h = libtcod.random_get_int(rngs['mapgen'], ROOM_MIN_SIZE, ROOM_MAX_SIZE)
         # random position without leaving boundary of map
-        x = libtcod.random_get_int(0, 0, MAP_WIDTH - w - 1)
-        y = libtcod.random_get_int(0, 0, MAP_HEIGHT - h - 1)
+        x = libtcod.random_get_int(rngs['mapgen'], 0, MAP_WIDTH - w - 1)
+        y = libtcod.random_get_int(rngs['mapgen'], 0, MAP_HEIGHT - h - 1)
     
         new_room = Rect(x, y, w, h)
     
-        #run through other rooms to check for overlaps
-        failed = False
-        for other_room in rooms:
-            if new_room.intersect(other_room):
-                failed = True
-                break
-            
-        if not failed:
-            # draw the room
-            create_room(new_room)
+        # check for overlaps with the other rooms. if there are any move the room
+        # somewhere free nearby, and if there's nowhere try it at the smallest size
+        if grid.overlaps(new_room):
+            spot = grid.nearest_free(x, y, w, h, ROOM_RETRY_REACH)
+            if spot is None:
+                (w, h) = (ROOM_MIN_SIZE, ROOM_MIN_SIZE)
+                spot = grid.nearest_free(x, y, w, h, ROOM_RETRY_REACH)
+            new_room = None
+            if spot is not None:
+                new_room = Rect(spot[0], spot[1], w, h)
             
-            # add objects to the room
-            place_objects(new_room)
-        
-            # get the center coordinates
-            (new_x, new_y) = new_room.center()
-        
-            if num_rooms == 0:
-                # set starting point in the first room
-                player.x = new_x
-                player.y = new_y
-          
+        if new_room is not None:
+            grid.add(new_room)
+            add_room(rooms, new_room)
+
+    return rooms
+
+# the bsp generator: the map is split in two over and over, down to pieces
+# about big enough for the biggest room, and every piece gets a room. nothing is tried and
+# thrown away, and neighbouring pieces come one after the other so the
+# tunnels between them stay short
+def make_bsp_rooms():
+    rooms = []
+    leaf_size = ROOM_MAX_SIZE + BSP_ROOM_GAP
+    root = libtcod.bsp_new_with_size(0, 0, MAP_WIDTH, MAP_HEIGHT)
+    libtcod.bsp_split_recursive(root, rngs['mapgen'], BSP_DEPTH, leaf_size, leaf_size,
+        BSP_MAX_RATIO, BSP_MAX_RATIO)
+    leaves = libtcod.bsp_leaves(root)
+    libtcod.bsp_delete(root)
+
+    for (x, y, w, h) in leaves:
+        # a room somewhere in the piece, with x2 and y2 still inside it
+        room_w = min(ROOM_MAX_SIZE, w - BSP_ROOM_GAP)
+        room_h = min(ROOM_MAX_SIZE, h - BSP_ROOM_GAP)
+        if room_w < ROOM_MIN_SIZE or room_h < ROOM_MIN_SIZE:
+            continue
+        room_w = libtcod.random_get_int(rngs['mapgen'], ROOM_MIN_SIZE, room_w)
+        room_h = libtcod.random_get_int(rngs['mapgen'], ROOM_MIN_SIZE, room_h)
+        room_x = libtcod.random_get_int(rngs['mapgen'], x, x + w - 1 - room_w)
+        room_y = libtcod.random_get_int(rngs['mapgen'], y, y + h - 1 - room_h)
+        add_room(rooms, Rect(room_x, room_y, room_w, room_h))
+
+    return rooms
+
+# one smoothing step of the caves generator over the whole map at once. the
+# rock neighbours of every cell are counted by adding up the map shifted each
+# of the 8 ways, with everything off the edge counted as rock
+def cave_step(walls):
+    (height, width) = walls.shape
+    padded = numpy.ones((height + 2, width + 2), dtype=numpy.uint8)
+    padded[1:-1, 1:-1] = walls
+    count = numpy.zeros((height, width), dtype=numpy.uint8)
+    for (dx, dy) in DIRECTIONS:
+        count += padded[1 + dy:1 + dy + height, 1 + dx:1 + dx + width]
+    return numpy.where(walls, count >= CAVE_SURVIVE, count >= CAVE_BIRTH)
+
+# tunnel a pocket of the cave to the nearest floor already joined up, looking
+# further and further out from (x, y) in the pocket until some is found
+def join_pocket(joined, x, y):
+    (height, width) = joined.shape
+    reach = CAVE_AREA_SIZE
+    while True:
+        (x1, y1) = (max(0, x - reach), max(0, y - reach))
+        (ys, xs) = numpy.nonzero(joined[y1:y + reach + 1, x1:x + reach + 1])
+        if len(xs) or reach > max(width, height):
+            break
+        reach *= 2
+    nearest = numpy.argmin((xs + x1 - x) ** 2 + (ys + y1 - y) ** 2)
+    (to_x, to_y) = (int(xs[nearest]) + x1, int(ys[nearest]) + y1)
+
+    # flip a coin for which way the bend goes, like the tunnels between rooms
+    if libtcod.random_get_int(rngs['mapgen'], 0, 1) == 1:
+        create_h_tunnel(x, to_x, y)
+        create_v_tunnel(y, to_y, to_x)
+        joined[y, min(x, to_x):max(x, to_x) + 1] = True
+        joined[min(y, to_y):max(y, to_y) + 1, to_x] = True
+    else:
+        create_v_tunnel(y, to_y, x)
+        create_h_tunnel(x, to_x, to_y)
+        joined[min(y, to_y):max(y, to_y) + 1, x] = True
+        joined[to_y, min(x, to_x):max(x, to_x) + 1] = True
+
+# the caves generator: random rock smoothed into caves with whole map array
+# steps, not cell by cell. every pocket of floor is joined to the rest, biggest
+# first, from the cell nearest it's middle. returns the squares of the cave
+# with enough floor in as rooms, row by row
+def make_caves():
+    # the noise comes from numpy, one call for the whole map, seeded from the
+    # mapgen stream so the same seed makes the same caves
+    noise = numpy.random.RandomState(libtcod.random_get_int(rngs['mapgen'], 0, 0x7fffffff))
+    walls = noise.random_sample((MAP_HEIGHT, MAP_WIDTH)) < CAVE_FILL
+    for i in range(CAVE_STEPS):
+        walls = cave_step(walls)
+    walls[0, :] = walls[-1, :] = walls[:, 0] = walls[:, -1] = True
+
+    # fill in the little pockets, keeping the biggest whatever it's size
+    floor = ~walls
+    (labels, sizes) = label_areas(floor)
+    keep = sizes >= CAVE_MIN_POCKET
+    if len(sizes):
+        keep[numpy.argmax(sizes)] = True
+    floor[floor] = keep[labels[floor]]
+    map.carve(0, 0, floor)
+
+    # the cells of each pocket, with the pockets one after the other
+    (ys, xs) = numpy.nonzero(floor)
+    order = numpy.argsort(labels[ys, xs], kind='mergesort')
+    (ys, xs) = (ys[order], xs[order])
+    ends = numpy.cumsum(numpy.where(keep, sizes, 0))
+
+    joined = numpy.zeros_like(floor)
+    for pocket in sorted(numpy.nonzero(keep)[0].tolist(), key=lambda p: -sizes[p]):
+        start = ends[pocket] - sizes[pocket]
+        (pocket_xs, pocket_ys) = (xs[start:ends[pocket]], ys[start:ends[pocket]])
+        if joined.any():
+            (mx, my) = (pocket_xs.mean(), pocket_ys.mean())
+            middle = numpy.argmin((pocket_xs - mx) ** 2 + (pocket_ys - my) ** 2)
+            join_pocket(joined, int(pocket_xs[middle]), int(pocket_ys[middle]))
+        joined[pocket_ys, pocket_xs] = True
+
+    # how much of each square is floor, then fill the ones with enough
+    size = CAVE_AREA_SIZE
+    (rows, cols) = (-(-MAP_HEIGHT // size), -(-MAP_WIDTH // size))
+    padded = numpy.zeros((rows * size, cols * size), dtype=bool)
+    padded[:MAP_HEIGHT, :MAP_WIDTH] = joined
+    counts = padded.reshape((rows, size, cols, size)).sum(axis=3).sum(axis=1)
+    rooms = []
+    for (row, col) in zip(*numpy.nonzero(counts >= CAVE_AREA_FLOOR * size * size)):
+        (x, y) = (int(col) * size, int(row) * size)
+        # the inside of the rect is the square
+        area = Rect(x - 1, y - 1, min(size, MAP_WIDTH - x) + 1, min(size, MAP_HEIGHT - y) + 1)
+        place_objects(area)
+        rooms.append(area)
+
+    return rooms
+
+MAP_GENERATORS = {
+    'rooms': make_random_rooms,
+    'bsp': make_bsp_rooms,
+    'caves': make_caves,
+}
+
+# number the separate areas of a plane of bools, counting cells as joined if
+# they touch on a side or a corner. returns the labels, -1 where the plane is
+# false, and the number of cells with each label. works on runs of cells along
+# the rows rather than cell by cell: runs that touch runs on the row above are
+# joined, then each run is filled in with it's label
+def label_areas(plane):
+    (height, width) = plane.shape
+    labels = numpy.empty((height, width), dtype=numpy.int32)
+    labels[:] = -1
+
+    # where runs start and end along each row, end exclusive. nonzero goes row
+    # by row so the starts and ends line up
+    padded = numpy.zeros((height, width + 2), dtype=numpy.int8)
+    padded[:, 1:-1] = plane
+    edges = numpy.diff(padded, axis=1)
+    (run_ys, starts) = numpy.nonzero(edges == 1)
+    ends = numpy.nonzero(edges == -1)[1]
+    first_run = numpy.searchsorted(run_ys, numpy.arange(height + 1)).tolist()
+    (run_ys, starts, ends) = (run_ys.tolist(), starts.tolist(), ends.tolist())
+
+    parent = list(range(len(starts)))
+    def find(run):
+        while parent[run] != run:
+            parent[run] = parent[parent[run]]
+            run = parent[run]
+        return run
+
+    for y in range(1, height):
+        (i, i_end) = (first_run[y - 1], first_run[y])
+        (j, j_end) = (first_run[y], first_run[y + 1])
+        while i < i_end and j < j_end:
+            if starts[i] <= ends[j] and starts[j] <= ends[i]:
+                parent[find(i)] = find(j)
+            # whichever run finishes first can't touch anything further along
+            if ends[i] < ends[j]:
+                i += 1
             else:
-                # for all rooms after the first, make a tunnel from the previous room
-                # using the center coordinates of the previous room
-                (prev_x, prev_y) = rooms[num_rooms-1].center()
-        
-                # flip a coin
-                if libtcod.random_get_int(0, 0, 1) == 1:
-                    # horizontal first, vertical second
-                    create_h_tunnel(prev_x, new_x, prev_y)
-                    create_v_tunnel(prev_y, new_y, new_x)
-                
-                else:
-                    # vertical first, horizontal second
-                    create_v_tunnel(prev_y, new_y, prev_x)
-                    create_h_tunnel(prev_x, new_x, new_y)
-           
-            # append the new room to the list
-            rooms.append(new_room)
-            num_rooms += 1
+                j += 1
+
+    numbers = {}
+    for run in range(len(starts)):
+        label = numbers.setdefault(find(run), len(numbers))
+        labels[run_ys[run], starts[run]:ends[run]] = label
+    sizes = numpy.bincount(labels[labels >= 0], minlength=len(numbers))
+    return (labels, sizes)
+
+# pairs of slices that line each cell up with it's neighbour at (dx, dy)
+def neighbour_slices(dx, dy, height, width):
+    here = (slice(max(0, -dy), height - max(0, dy)), slice(max(0, -dx), width - max(0, dx)))
+    there = (slice(max(0, dy), height - max(0, -dy)), slice(max(0, dx), width - max(0, -dx)))
+    return (here, there)
+
+# work out the regions of a map and how it's rooms join up
+def find_regions(tiles, rects):
+    (width, height) = (tiles.width, tiles.height)
+    floor = ~tiles.blocked[0:height, 0:width]
+    (labels, sizes) = label_areas(floor)
+
+    rooms = numpy.empty((height, width), dtype=numpy.int32)
+    rooms[:] = -1
+    for (index, rect) in enumerate(rects):
+        rooms[rect.y1 + 1:rect.y2, rect.x1 + 1:rect.x2] = index
+    rooms[~floor] = -1
+
+    # the floor outside the rooms is tunnels. rooms are neighbours if they touch
+    # the same stretch of tunnel, or each other
+    (tunnels, tunnel_sizes) = label_areas(floor & (rooms < 0))
+    touching = [set() for tunnel in tunnel_sizes]
+    neighbours = [set() for rect in rects]
+    for (dx, dy) in DIRECTIONS:
+        (here, there) = neighbour_slices(dx, dy, height, width)
+        (room, other) = (rooms[here], rooms[there])
+        joined = (room >= 0) & (other >= 0) & (room != other)
+        for (a, b) in set(zip(room[joined].tolist(), other[joined].tolist())):
+            neighbours[a].add(b)
+        tunnel = tunnels[here]
+        joined = (tunnel >= 0) & (other >= 0)
+        for (t, b) in set(zip(tunnel[joined].tolist(), other[joined].tolist())):
+            touching[t].add(b)
+    for joined in touching:
+        for room in joined:
+            neighbours[room].update(joined)
+            neighbours[room].discard(room)
+
+    # kept in chunks, the whole map planes are only needed while working it out
+    (label_plane, room_plane) = (LabelPlane(tiles, len(sizes)), LabelPlane(tiles, len(rects)))
+    label_plane.fill(labels)
+    room_plane.fill(rooms)
+    return Regions(label_plane, sizes, room_plane, rects, [sorted(n) for n in neighbours])
 
 # object placement
 def place_objects(room):
     # choose a random number of monsters up to the max
-    num_monsters = libtcod.random_get_int(0, 0, MAX_ROOM_MONSTERS)
+    num_monsters = libtcod.random_get_int(rngs['spawn'], 0, MAX_ROOM_MONSTERS)
     
     for i in range(num_monsters):
         # choose a random spot for the monster
-        x = libtcod.random_get_int(0, room.x1 + 1, room.x2 - 1)
-        y = libtcod.random_get_int(0, room.y1 + 1, room.y2 - 1)
+        x = libtcod.random_get_int(rngs['spawn'], room.x1 + 1, room.x2 - 1)
+        y = libtcod.random_get_int(rngs['spawn'], room.y1 + 1, room.y2 - 1)
         
         if not is_blocked(x, y):
-            if libtcod.random_get_int(0, 0, 100) < 80: # 80% chance of this
+            if libtcod.random_get_int(rngs['spawn'], 0, 100) < 80: # 80% chance of this
                 # create a rat
                 fighter_component = Fighter(hp=10, defense=0, power=3, death_function=monster_death)
                 ai_component = BasicMonster()
@@ -456,18 +1899,18 @@ def place_objects(room):
                 monster = Object(x, y, 'R', 'radioactive rat', libtcod.desaturated_green,
                     blocks=True, fighter=fighter_component, ai=ai_component)
             
-            objects.append(monster)
+            add_object(monster)
             
     # choose a random number of items up to the max
-    num_items = libtcod.random_get_int(0, 0, MAX_ROOM_ITEMS)
+    num_items = libtcod.random_get_int(rngs['spawn'], 0, MAX_ROOM_ITEMS)
     
     for i in range(num_items):
         # choose a random spot for the items
-        x = libtcod.random_get_int(0, room.x1 + 1, room.x2 - 1)
-        y = libtcod.random_get_int(0, room.y1 + 1, room.y2 - 1)
+        x = libtcod.random_get_int(rngs['spawn'], room.x1 + 1, room.x2 - 1)
+        y = libtcod.random_get_int(rngs['spawn'], room.y1 + 1, room.y2 - 1)
         
         if not is_blocked(x, y):
-            dice = libtcod.random_get_int(0, 0, 100)
+            dice = libtcod.random_get_int(rngs['spawn'], 0, 100)
             if dice < 50:
                 # create a regular heal potion (50% chance)
                 item_component = Item(use_function=cast_heal)
@@ -489,7 +1932,7 @@ def place_objects(room):
                 item = Object(x, y, '?', 'scroll of Confusion', libtcod.white, item=item_component)
                 
             
-            objects.append(item)
+            add_object(item)
             item.send_to_back() # items should appear below monsters and stuff
 
 # status bar
@@ -514,64 +1957,199 @@ def get_names_under_mouse():
     global mouse
     
     # return a string with the names of all objects under the mouse
-    (x, y) = (mouse.cx, mouse.cy)
+    (w, h) = view_size()
+    if not (0 <= mouse.cx < w and 0 <= mouse.cy < h):
+        return ''
+    (x, y) = (mouse.cx + camera_x, mouse.cy + camera_y)
     
     # create a list with the names of objects at the mouse's coordinates and in FOV
-    names = [obj.name for obj in objects
-        if obj.x == x and obj.y == y and libtcod.map_is_in_fov(fov_map, obj.x, obj.y)]
+    names = [obj.name for obj in object_index.at(x, y)
+        if is_visible(obj.x, obj.y)]
         
     names = ', '.join(names) # join the names, and separate with commas
     return names.capitalize()
         
-# render function
-def render_all():
-    
-    global fov_map, color_dark_wall, color_light_wall
-    global color_dark_ground, color_light_ground
-    global fov_recompute
-       
-    # fov 
+# read the field of view back out of the fov map as a plane
+def get_visible_tiles():
+    return libtcod.map_get_fov_array(fov_map)
+
+# is (x, y) in the player's field of view. use this rather than asking the fov
+# map, which isn't recomputed when the fov comes from the cache
+def is_visible(x, y):
+    return in_local_area(x, y) and visible_tiles[y - local_y, x - local_x]
+
+# the field of view over a rectangle of the map, x2 and y2 exclusive.
+# everything outside the local area is out of view
+def visible_rect(x1, y1, x2, y2):
+    visible = numpy.zeros((y2 - y1, x2 - x1), dtype=bool)
+    (ax1, ay1) = (max(x1, local_x), max(y1, local_y))
+    (ax2, ay2) = (min(x2, local_x + local_width), min(y2, local_y + local_height))
+    if ax1 < ax2 and ay1 < ay2:
+        visible[ay1 - y1:ay2 - y1, ax1 - x1:ax2 - x1] = visible_tiles[
+            ay1 - local_y:ay2 - local_y, ax1 - local_x:ax2 - local_x]
+    return visible
+
+# fov 
+def update_fov():
+    global fov_recompute, visible_tiles
+
+    follow_player()
     if fov_recompute:
-        # recompute fov if required
+        # recompute fov if required, unless it's been worked out from here before
         fov_recompute = False
-        libtcod.map_compute_fov(fov_map, player.x, player.y, TORCH_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
-        
-    # draw the map
-    for y in range(MAP_HEIGHT):
-        for x in range(MAP_WIDTH):
-            visible = libtcod.map_is_in_fov(fov_map, x, y)
-            wall = map[x][y].block_sight
-            if not visible:
-                # prevent player from seeing tiles that haven't previously been uncovered
-                if map[x][y].explored:
-                    if wall:
-                        libtcod.console_set_char_background(
-                            con, x, y, color_dark_wall, libtcod.BKGND_SET)
-                    else:
-                        libtcod.console_set_char_background(
-                            con, x, y, color_dark_ground, libtcod.BKGND_SET)
-            else:
-                if wall:
-                    libtcod.console_set_char_background(
-                        con, x, y, color_light_wall,libtcod.BKGND_SET)
-                else:
-                    libtcod.console_set_char_background(
-                        con, x, y, color_light_ground, libtcod.BKGND_SET)
-                map[x][y].explored = True
-    
-    # draw all objects in the object list 
-    for object in objects:
-        if object != player:
-            object.draw()
-    player.draw()
-                
-    libtcod.console_blit(con, 0, 0, MAP_WIDTH, MAP_HEIGHT, 0, 0, 0)    
+        fov_key = (player.x, player.y, TORCH_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO, map.revision,
+            local_x, local_y)
+        visible_tiles = fov_cache.get(fov_key)
+        if visible_tiles is None:
+            libtcod.map_compute_fov(fov_map, player.x - local_x, player.y - local_y,
+                TORCH_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
+            visible_tiles = get_visible_tiles()
+            fov_cache.put(fov_key, visible_tiles)
+
+        # everything in view is now explored
+        map.explored[local_y:local_y + local_height, local_x:local_x + local_width] |= visible_tiles
+
+# the size of the part of the map on screen, the view or the whole map if
+# that's smaller
+def view_size():
+    return (min(VIEW_WIDTH, MAP_WIDTH), min(VIEW_HEIGHT, MAP_HEIGHT))
+
+# scroll the camera so the player is at least CAMERA_MARGIN in from the edge
+# of the view, without showing anything past the edge of the map. everything is
+# redrawn after a scroll
+def move_camera():
+    global camera_x, camera_y
+    (w, h) = view_size()
+    margin_x = min(CAMERA_MARGIN, (w - 1) // 2)
+    margin_y = min(CAMERA_MARGIN, (h - 1) // 2)
+    x = min(max(camera_x, player.x + margin_x - w + 1), player.x - margin_x)
+    y = min(max(camera_y, player.y + margin_y - h + 1), player.y - margin_y)
+    x = max(0, min(x, MAP_WIDTH - w))
+    y = max(0, min(y, MAP_HEIGHT - h))
+    if (x, y) != (camera_x, camera_y):
+        (camera_x, camera_y) = (x, y)
+        render_invalidate()
+
+# wipe the map console and forget what was on it, so the next render_all
+# redraws all of it. needed after anything else has drawn over the map area of
+# the root console, and when what's in view is moved or replaced, so nothing is
+# left behind from before. the console is made again if the map size changed
+def render_invalidate():
+    global drawn_shades, drawn_glyphs, con
+    (w, h) = view_size()
+    drawn_shades = numpy.full((h, w), -1, dtype=numpy.intc)
+    drawn_glyphs = {}
+    if con is not None:
+        if (libtcod.console_get_width(con), libtcod.console_get_height(con)) != (w, h):
+            libtcod.console_delete(con)
+            con = libtcod.console_new(w, h)
+        libtcod.console_clear(con)
+
+# render function. only the part of the map in view is looked at, so it costs
+# the same however big the map is
+def render_all():
+    global cells_redrawn
+
+    move_camera()
+
+    # cells of the map console that get drawn this frame
+    (w, h) = view_size()
+    dirty = numpy.zeros((h, w), dtype=bool)
+
+    with span('fov'):
+        update_fov()
+        visible = visible_rect(camera_x, camera_y, camera_x + w, camera_y + h)
+    with span('map'):
+        render_map(dirty, visible)
+    with span('objects'):
+        render_objects(dirty, visible)
+    with span('blit'):
+        cells_redrawn = blit_map(dirty)
+    add_counter('cells redrawn', cells_redrawn)
+    with span('panel'):
+        render_panel()
+
+# draw the map tiles in view that changed since the last frame
+def render_map(dirty, visible):
+    global drawn_shades
+
+    (h, w) = dirty.shape
+    explored = map.explored[camera_y:camera_y + h, camera_x:camera_x + w]
+    block_sight = map.block_sight[camera_y:camera_y + h, camera_x:camera_x + w]
 
-    # render status bar thing 
+    # work out the palette entry for every cell at once, unexplored tiles stay
+    # black so the player can't see what hasn't been uncovered yet
+    shades = (explored.astype(numpy.intc) + (explored & block_sight) + 2 * visible)
+
+    # only cells whose shade changed since the last frame need drawing
+    changed = shades != drawn_shades
+    num_changed = numpy.count_nonzero(changed)
+    if num_changed > DIRTY_FILL_LIMIT:
+        background = background_palette[shades]
+        libtcod.console_fill_background(con,
+            background[:, :, 0].ravel(), background[:, :, 1].ravel(), background[:, :, 2].ravel())
+    elif num_changed > 0:
+        for (y, x) in zip(*numpy.nonzero(changed)):
+            libtcod.console_set_char_background(
+                con, x, y, background_colors[shades[y, x]], libtcod.BKGND_SET)
+    drawn_shades = shades
+    dirty |= changed
     
+# draw the objects that moved, appeared, changed or went away
+def render_objects(dirty, visible):
+    global drawn_glyphs
+
+    # only the things in the sectors of the spatial index under the view are
+    # looked at, so this costs the same however many there are on the level.
+    # their positions are checked all at once from the position arrays, in
+    # console coordinates from here on
+    (h, w) = dirty.shape
+    positions = world.position
+    candidates = object_index.in_sectors(camera_x, camera_y, camera_x + w - 1, camera_y + h - 1)
+    slots = numpy.array([positions.slots[obj.eid] for obj in candidates], dtype=numpy.intp)
+    (xs, ys) = (positions.xs[slots] - camera_x, positions.ys[slots] - camera_y)
+    in_view = numpy.nonzero((xs >= 0) & (xs < w) & (ys >= 0) & (ys < h))[0]
+    in_view = in_view[visible[ys[in_view], xs[in_view]]]
+
+    # work out which object shows in each cell, lower layers first so they end
+    # up underneath, and the player on top of everything
+    shown = []
+    for i in in_view:
+        obj = candidates[i]
+        (char, color, layer) = world.glyph.get(obj.eid)
+        shown.append((layer, obj.eid, int(xs[i]), int(ys[i]), obj, char, color))
+    shown.sort()
+    glyphs = {}
+    for (layer, eid, x, y, obj, char, color) in shown:
+        glyphs[(x, y)] = (obj, char, color)
+    glyphs[(player.x - camera_x, player.y - camera_y)] = (player, player.char, player.color)
+
+    # erase objects that have gone, and draw the ones that moved or changed
+    for (x, y) in drawn_glyphs:
+        if (x, y) not in glyphs:
+            libtcod.console_put_char(con, x, y, ' ', libtcod.BKGND_NONE)
+            dirty[y, x] = True
+    for ((x, y), glyph) in glyphs.items():
+        old = drawn_glyphs.get((x, y))
+        if old is None or old[0] is not glyph[0] or old[1] != glyph[1] or old[2] is not glyph[2]:
+            glyph[0].draw()
+            dirty[y, x] = True
+    drawn_glyphs = glyphs
+
+# blit the part of the map that changed, and return how many cells that was
+def blit_map(dirty):
+    num_dirty = int(numpy.count_nonzero(dirty))
+    if num_dirty > 0:
+        (ys, xs) = numpy.nonzero(dirty)
+        (x1, y1) = (xs.min(), ys.min())
+        (w, h) = (xs.max() - x1 + 1, ys.max() - y1 + 1)
+        libtcod.console_blit(con, x1, y1, w, h, 0, x1, y1)
+    return num_dirty
+
+# render status bar thing 
+def render_panel():
     libtcod.console_set_default_background(panel, libtcod.black)
     libtcod.console_clear(panel)
-    
             
     # print the messages, one line at a time
     y = 1
@@ -584,6 +2162,8 @@ def render_all():
     
     render_bar(1, 3, BAR_WIDTH, 'HP', player.fighter.hp, player.fighter.max_hp,
         libtcod.light_red, libtcod.darker_red)
+    libtcod.console_print_ex(panel, 1, 5, libtcod.BKGND_NONE, libtcod.LEFT,
+        'Sewer level ' + str(current_level.depth))
                 
     # display names of objects under the mouse
     libtcod.console_set_default_foreground(panel, libtcod.light_gray)
@@ -616,8 +2196,8 @@ def player_move_or_attack(dx, dy):
     
     # check for attackable object there
     target = None
-    for object in objects:
-        if object.fighter and object.x == x and object.y == y:
+    for object in object_index.at(x, y):
+        if object.fighter:
             target = object
             break
             
@@ -634,9 +2214,16 @@ def handle_keys():
     global keys
         
     # Alt + Enter : toggle fullscreen
-    if key.vk == libtcod.KEY_ENTER and key.lalt:
+    if key.vk == libtcod.KEY_ENTER and key.lalt and not headless:
         libtcod.console_set_fullscreen(not libtcod.console_is_fullscreen())
-    
+
+    # F12 : start or stop timing the frames
+    elif key.vk == libtcod.KEY_F12:
+        if timing:
+            stop_timing()
+        else:
+            start_timing()
+
     # Esc : exit game    
     elif key.vk == libtcod.KEY_ESCAPE:
         return 'exit' 
@@ -673,8 +2260,8 @@ def handle_keys():
             
             if key_char == 'g':
                 # pick up (Get) item
-                for object in objects:
-                    if object.x == player.x and object.y == player.y and object.item:
+                for object in object_index.at(player.x, player.y):
+                    if object.item:
                         object.item.pick_up()
                         break
                         
@@ -684,6 +2271,16 @@ def handle_keys():
                     'Press the key next to an item to use it, or any other to cancel.\n')
                 if chosen_item is not None:
                     chosen_item.use()
+
+            if key_char == '>':
+                # go down the stairs, if the player is on them
+                if (player.x, player.y) == current_level.down_stairs:
+                    change_level(current_level.depth + 1)
+
+            if key_char == '<':
+                # go up the stairs, if there are any and the player is on them
+                if current_level.depth > 1 and (player.x, player.y) == current_level.up_stairs:
+                    change_level(current_level.depth - 1)
                         
             return 'didnt-take-turn'
             
@@ -714,31 +2311,35 @@ def monster_death(monster):
 def menu(header, options, width):
     if len(options) > 26:
         raise ValueError('Cannot have a menu with more than 26 options')
-    # calculate total height for the header (after auto-wrap) and one line per option
-    header_height = libtcod.console_get_height_rect(
-        con, 0, 0, width, SCREEN_HEIGHT, header)
-    height = len(options) + header_height
-    # create a console off screen that represents the menu's window
-    window = libtcod.console_new(width, height)
-    # print the header, wrap if required
-    libtcod.console_set_default_foreground(window, libtcod.white)
-    libtcod.console_print_rect_ex(
-        window, 0, 0, width, height, libtcod.BKGND_NONE, libtcod.LEFT, header)
-    # print all the options
-    y = header_height
-    letter_index = ord('a')
-    for option_text in options:
-        text = '(' + chr(letter_index) + ') ' + option_text
-        libtcod.console_print_ex(window, 0, y, libtcod.BKGND_NONE, libtcod.LEFT, text)
-        y += 1
-        letter_index += 1
-    # blit the contents of the window to the root console
-    x = SCREEN_WIDTH/2 - width/2
-    y = SCREEN_HEIGHT/2 - height/2
-    libtcod.console_blit(window, 0, 0, width, height, 0, x, y, 1.0, 0.7)
-    # present the root console to the player and wit for a key press
-    libtcod.console_flush()
-    key = libtcod.console_wait_for_keypress(True)
+    if not headless:
+        # calculate total height for the header (after auto-wrap) and one line per option
+        header_height = libtcod.console_get_height_rect(
+            con, 0, 0, width, SCREEN_HEIGHT, header)
+        height = len(options) + header_height
+        # create a console off screen that represents the menu's window
+        window = libtcod.console_new(width, height)
+        # print the header, wrap if required
+        libtcod.console_set_default_foreground(window, libtcod.white)
+        libtcod.console_print_rect_ex(
+            window, 0, 0, width, height, libtcod.BKGND_NONE, libtcod.LEFT, header)
+        # print all the options
+        y = header_height
+        letter_index = ord('a')
+        for option_text in options:
+            text = '(' + chr(letter_index) + ') ' + option_text
+            libtcod.console_print_ex(window, 0, y, libtcod.BKGND_NONE, libtcod.LEFT, text)
+            y += 1
+            letter_index += 1
+        # blit the contents of the window to the root console
+        x = SCREEN_WIDTH/2 - width/2
+        y = SCREEN_HEIGHT/2 - height/2
+        libtcod.console_blit(window, 0, 0, width, height, 0, x, y, 1.0, 0.7)
+        # present the root console to the player
+        libtcod.console_flush()
+    # wait for a key press
+    key = wait_for_key()
+    # the menu was drawn over the map, so it all needs drawing again
+    render_invalidate()
     # convert the ASCII code to an index - if it corresponds to an option then return it
     index = key.c - ord('a')
     if index >= 0 and index < len(options): return index
@@ -761,71 +2362,493 @@ def inventory_menu(header):
 ###############################        
         
 # set up console
-libtcod.console_set_custom_font(
-    'terminal12x12_gs_ro.png', libtcod.FONT_LAYOUT_ASCII_INROW | libtcod.FONT_TYPE_GREYSCALE)
-libtcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT, 'Lands of Lothariel', False)
-libtcod.sys_set_fps(LIMIT_FPS)
-con = libtcod.console_new(MAP_WIDTH, MAP_HEIGHT)
-panel = libtcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
+def init_console():
+    global con, panel
+    libtcod.console_set_custom_font(
+        'terminal12x12_gs_ro.png', libtcod.FONT_LAYOUT_ASCII_INROW | libtcod.FONT_TYPE_GREYSCALE)
+    libtcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT, 'Lands of Lothariel', False)
+    libtcod.sys_set_fps(LIMIT_FPS)
+    (w, h) = view_size()
+    con = libtcod.console_new(w, h)
+    panel = libtcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
+
+# start a fresh game, with a random seed unless one is given
+def new_game(seed=None):
+    global levels, player, inventory, game_state, game_msgs
+
+    if seed is None:
+        seed = int(time.time() * 1000) & 0xffffffff
+    seed_rngs(seed)
+
+    # the dungeon, starting with the first level
+    if levels is not None:
+        levels.close()
+    levels = LevelManager(LEVEL_CACHE_SIZE)
+    level = levels.get(1)
+
+    # player init
+    fighter_component = Fighter(hp=30, defense=2, power=5, death_function=player_death)
+    player = Object(0, 0, '@', 'player', libtcod.white, blocks=True, fighter=fighter_component)
+
+    # player's inventory
+    inventory = []
+
+    enter_level(level, level.up_stairs)
+
+    game_state = 'playing'
+
+    # list of messages in the game
+    game_msgs = []
+
+    # welcome text
+    message(
+        'You stumble into the sewers beneath the fortress of Lothariel.'
+        ' Who knows what awaits? You feel uneasy...', libtcod.red)
+
+# levels
+# make the level at depth, with stairs down in the last room and stairs up
+# in the first. if the last room can't be reached from the first the stairs
+# down go in the room furthest from the first that can. the random streams are
+# left as they were, so making a level here draws nothing the game would
+# otherwise get, the same as when a worker makes it
+def generate_level(depth):
+    global world, object_index
+
+    # everything made goes in a world of it's own
+    world = World()
+    object_index = SpatialIndex()
+
+    saved_rngs = save_rngs()
+    seed_level_rngs(depth)
+    rooms = make_map()
+    regions = find_regions(map, rooms)
+
+    up_stairs = regions.spot(0)
+    down_stairs = regions.spot(len(rooms) - 1)
+    if not regions.connected(up_stairs[0], up_stairs[1], down_stairs[0], down_stairs[1]):
+        down_stairs = regions.spot(regions.farthest_room(0))
+    if depth > 1:
+        stairs = Object(up_stairs[0], up_stairs[1], '<', 'stairs up', libtcod.white)
+        add_object(stairs)
+        stairs.send_to_back()
+    stairs = Object(down_stairs[0], down_stairs[1], '>', 'stairs down', libtcod.white)
+    add_object(stairs)
+    stairs.send_to_back()
+
+    saved_rngs.restore()
+    saved_rngs.delete()
+    return Level(depth, map, world, up_stairs, down_stairs, regions)
+
+# make the level at depth as a packed record, in a worker process. settings are
+# the map size, room contents and generator, which the worker doesn't share
+# with the game
+def level_record(seed, depth, settings):
+    global game_seed, MAP_WIDTH, MAP_HEIGHT, MAX_ROOMS, MAX_ROOM_MONSTERS, MAX_ROOM_ITEMS
+    global MAP_GENERATOR
+    (MAP_WIDTH, MAP_HEIGHT, MAX_ROOMS, MAX_ROOM_MONSTERS, MAX_ROOM_ITEMS,
+        MAP_GENERATOR) = settings
+    game_seed = seed
+    return pack_level(generate_level(depth))
+
+# make level the current one, with the player at position
+def enter_level(level, position):
+    global current_level, map, world, object_index, scheduler
+
+    current_level = level
+    map = level.map
+    world = level.world
+
+    # the player and everything they carry come too
+    for obj in [player] + inventory:
+        if obj.world is not world:
+            world.adopt(obj)
+    if player.eid in world.position:
+        (player.x, player.y) = position
+    else:
+        world.position.add(player.eid, position[0], position[1])
+
+    # the index and the turn order aren't kept with the level, work them out again
+    object_index = SpatialIndex()
+    scheduler = Scheduler()
+    for eid in list(world.position.entities):
+        add_object(world.objects[eid])
+
+    initialize_fov()
+
+    # get the next level ready
+    if PREGENERATE:
+        levels.pregenerate(level.depth + 1)
+
+# take the stairs to the level at depth
+def change_level(depth):
+    going_down = depth > current_level.depth
+    level = levels.get(depth)
+    if going_down:
+        enter_level(level, level.up_stairs)
+        message('You climb down deeper into the sewers...', libtcod.light_violet)
+    else:
+        enter_level(level, level.down_stairs)
+        message('You climb back up.', libtcod.light_violet)
+
+# levels are packed into plain records to be kept on disk, with functions kept
+# by name and colors as (r, g, b)
+def function_name(function):
+    if function is None:
+        return ''
+    return function.__name__
+
+def named_function(name):
+    if not name:
+        return None
+    return globals()[name]
+
+def pack_ai(ai):
+    if ai is None:
+        return None
+    if isinstance(ai, ConfusedMonster):
+        return ('confused', ai.num_turns, pack_ai(ai.old_ai))
+    return ('basic', ai.tracking, ai.asleep)
+
+def unpack_ai(record):
+    if record is None:
+        return None
+    if record[0] == 'confused':
+        return ConfusedMonster(unpack_ai(record[2]), record[1])
+    ai = BasicMonster()
+    ai.tracking = record[1]
+    ai.asleep = record[2]
+    if ai.tracking > 0:
+        ai.path = CachedPath()
+    return ai
+
+def pack_level(level):
+    tiles = level.map
+    entities = []
+    for eid in sorted(level.world.objects):
+        obj = level.world.objects[eid]
+        (char, color, layer) = level.world.glyph.get(eid)
+        fighter = None
+        if obj.fighter:
+            f = obj.fighter
+            fighter = (f.max_hp, f.hp, f.defense, f.power, function_name(f.death_function))
+        item = None
+        if obj.item:
+            item = function_name(obj.item.use_function)
+        entities.append((obj.name, obj.x, obj.y, char, (color.r, color.g, color.b), layer,
+            obj.blocks, obj.speed, fighter, pack_ai(obj.ai), item))
+
+    return {
+        'depth': level.depth,
+        'width': tiles.width,
+        'height': tiles.height,
+        'revision': tiles.revision,
+        'chunks': [(cx, cy, numpy.packbits(chunk).tobytes())
+            for ((cx, cy), chunk) in sorted(tiles.chunks.items())],
+        'up_stairs': level.up_stairs,
+        'down_stairs': level.down_stairs,
+        'entities': entities,
+        'regions': pack_regions(level.regions),
+    }
+
+def unpack_level(record):
+    global world
+
+    (width, height) = (record['width'], record['height'])
+    tiles = TileMap(width, height)
+    tiles.revision = record['revision']
+    for (cx, cy, packed) in record['chunks']:
+        bits = numpy.unpackbits(numpy.frombuffer(packed, dtype=numpy.uint8))
+        tiles.chunks[(cx, cy)] = bits.reshape((3, CHUNK_SIZE, CHUNK_SIZE)).astype(bool)
+
+    # objects are made in the world that's current, so make them in the new one
+    saved_world = world
+    world = World()
+    for (name, x, y, char, color, layer, blocks, speed, fighter, ai, item) in record['entities']:
+        if fighter is not None:
+            (max_hp, hp, defense, power, death) = fighter
+            fighter = Fighter(max_hp, defense, power, named_function(death))
+            fighter.hp = hp
+        if item is not None:
+            item = Item(named_function(item))
+        obj = Object(x, y, char, name, libtcod.Color(*color), blocks=blocks,
+            fighter=fighter, ai=unpack_ai(ai), item=item, speed=speed)
+        world.glyph.get(obj.eid)[2] = layer
+    (level_world, world) = (world, saved_world)
 
-# player init
-fighter_component = Fighter(hp=30, defense=2, power=5, death_function=player_death)
-player = Object(0, 0, '@', 'player', libtcod.white, blocks=True, fighter=fighter_component)
+    return Level(record['depth'], tiles, level_world,
+        tuple(record['up_stairs']), tuple(record['down_stairs']),
+        unpack_regions(record['regions'], tiles))
 
-# list of objects in game
-objects = [player]
+# the label planes go as raw bytes, write_record squashes them
+def pack_regions(regions):
+    def chunks(plane):
+        return [(cx, cy, chunk.tobytes()) for ((cx, cy), chunk) in sorted(plane.chunks.items())]
+    return {
+        'labels': chunks(regions.labels),
+        'sizes': regions.sizes.tolist(),
+        'rooms': chunks(regions.rooms),
+        'rects': [(r.x1, r.y1, r.x2 - r.x1, r.y2 - r.y1) for r in regions.rects],
+        'neighbours': regions.neighbours,
+    }
 
-# player's inventory
-inventory = []
+def unpack_regions(record, tiles):
+    def plane(packed, count):
+        plane = LabelPlane(tiles, count)
+        for (cx, cy, data) in packed:
+            chunk = numpy.frombuffer(data, dtype=plane.dtype)
+            plane.chunks[(cx, cy)] = chunk.reshape((CHUNK_SIZE, CHUNK_SIZE)).copy()
+        return plane
+    sizes = numpy.array(record['sizes'], dtype=numpy.intp)
+    rects = [Rect(x, y, w, h) for (x, y, w, h) in record['rects']]
+    return Regions(plane(record['labels'], len(sizes)), sizes,
+        plane(record['rooms'], len(rects)), rects, [list(n) for n in record['neighbours']])
 
-# gen map
-make_map()
+def write_record(f, record):
+    f.write(zlib.compress(pickle.dumps(record, 2)))
+
+def read_record(f):
+    return pickle.loads(zlib.decompress(f.read()))
 
 # field of view
-fov_map = libtcod.map_new(MAP_WIDTH, MAP_HEIGHT)
-for y in range(MAP_HEIGHT):
-    for x in range(MAP_WIDTH):
-        libtcod.map_set_properties(fov_map, x, y, not map[x][y].block_sight, not map[x][y].blocked)
+def initialize_fov():
+    global fov_map, chase_map, chase_key, path_pool
+    global local_width, local_height, camera_x, camera_y
+
+    # let go of the last level's maps
+    if fov_map is not None:
+        path_pool.delete()
+        libtcod.dijkstra_delete(chase_map)
+        libtcod.map_delete(fov_map)
+
+    # the fov map covers the local area around the player
+    local_width = min(LOCAL_SIZE, MAP_WIDTH)
+    local_height = min(LOCAL_SIZE, MAP_HEIGHT)
+    fov_map = libtcod.map_new(local_width, local_height)
+    fov_cache.clear()
+    load_local_area(player.x - local_width // 2, player.y - local_height // 2)
+
+    # distances to the player over the same map, shared by every chasing monster
+    chase_map = libtcod.dijkstra_new(fov_map)
+    chase_key = None
+
+    # path objects for monsters tracking the player
+    path_pool = PathPool()
+
+    # start with the camera on the player, and nothing drawn yet
+    (w, h) = view_size()
+    (camera_x, camera_y) = (player.x - w // 2, player.y - h // 2)
+    move_camera()
+    render_invalidate()
 
+# is (x, y) inside the local area
+def in_local_area(x, y):
+    return local_x <= x < local_x + local_width and local_y <= y < local_y + local_height
 
-fov_recompute = True
+# move the local area to start at (x, y), or as near as it can without going
+# off the map, and copy the tiles there into the fov map
+def load_local_area(x, y):
+    global local_x, local_y, visible_tiles, fov_recompute, chase_key
+    local_x = max(0, min(x, MAP_WIDTH - local_width))
+    local_y = max(0, min(y, MAP_HEIGHT - local_height))
+    (x2, y2) = (local_x + local_width, local_y + local_height)
+    libtcod.map_set_properties_array(fov_map, ~map.block_sight[local_y:y2, local_x:x2],
+        ~map.blocked[local_y:y2, local_x:x2])
 
-game_state = 'playing'
-player_action = None
+    # everything worked out over the old area is out of date
+    visible_tiles = numpy.zeros((local_height, local_width), dtype=bool)
+    fov_recompute = True
+    chase_key = None
 
-# list of messages in the game
-game_msgs = []
+# move the local area along with the player once they get near an edge of it
+# that isn't the edge of the map
+def follow_player():
+    def near_edge(p, start, size, limit):
+        return ((p - start < LOCAL_MARGIN and start > 0) or
+            (start + size - p <= LOCAL_MARGIN and start + size < limit))
+    if (near_edge(player.x, local_x, local_width, MAP_WIDTH) or
+            near_edge(player.y, local_y, local_height, MAP_HEIGHT)):
+        load_local_area(player.x - local_width // 2, player.y - local_height // 2)
 
-# welcome text
-message(
-    'You stumble into the sewers beneath the fortress of Lothariel.'
-    ' Who knows what awaits? You feel uneasy...', libtcod.red)
+# bring the chase map up to date if the player or the map changed
+def update_chase_map():
+    global chase_key
+    follow_player()
+    key = (player.x, player.y, map.revision, local_x, local_y)
+    if key != chase_key:
+        libtcod.dijkstra_compute(chase_map, player.x - local_x, player.y - local_y)
+        chase_key = key
 
-# controls
-mouse = libtcod.Mouse()
-key = libtcod.Key()
+# the monsters get their turns, up until the player is ready to act again
+def take_monster_turns():
+    wake_monsters()
+    update_chase_map()
+    scheduler.run_until(scheduler.time + player.action_time())
 
 # main loop
-while not libtcod.console_is_window_closed():
-    
-    libtcod.sys_check_for_event(libtcod.EVENT_KEY_PRESS|libtcod.EVENT_MOUSE,key,mouse)
-    
-    render_all()
-    
-    libtcod.console_flush()
-    
-    # clear objects old position
-    for object in objects:
-        object.clear()
-    
-    # handle keys and exit game if requested
-    player_action = handle_keys()
-    if player_action == 'exit':
-        break
+def play_game():
+    global key, mouse
+
+    # controls
+    mouse = libtcod.Mouse()
+    key = libtcod.Key()
+
+    while not libtcod.console_is_window_closed():
+        frame_start = trace_clock()
+        
+        with span('input'):
+            libtcod.sys_check_for_event(libtcod.EVENT_KEY_PRESS|libtcod.EVENT_MOUSE,key,mouse)
+        
+        with span('render'):
+            render_all()
+        
+        with span('flush'):
+            libtcod.console_flush()
+        
+        # handle keys and exit game if requested
+        with span('handle_keys'):
+            player_action = handle_keys()
+        if player_action == 'exit':
+            break
+
+        # monsters turn
+        if game_state == 'playing' and player_action != 'didnt-take-turn':
+            with span('monsters'):
+                take_monster_turns()
+
+        add_span('frame', frame_start)
+
+    # write out whatever was being timed
+    if timing:
+        stop_timing()
+
+###############################
+# Headless mode
+###############################
+
+# turn key names into key presses: 'KP8', 'ESCAPE' and so on for special keys,
+# or a single character like 'g' or 'i'
+def scripted_keys(names):
+    for name in names:
+        key = libtcod.Key()
+        if len(name) == 1:
+            key.vk = libtcod.KEY_CHAR
+            key.c = ord(name)
+        else:
+            key.vk = getattr(libtcod, 'KEY_' + name.upper())
+        key.pressed = True
+        yield key
+
+# endless random walk over the keypad, for soak tests
+def random_walk_keys(seed=0):
+    rng = random.Random(seed)
+    names = ['KP1', 'KP2', 'KP3', 'KP4', 'KP6', 'KP7', 'KP8', 'KP9']
+    while True:
+        yield next(scripted_keys([rng.choice(names)]))
+
+# the next key press, from the player or from the script when headless
+def wait_for_key():
+    if headless:
+        return next(input_keys, libtcod.Key())
+    return libtcod.console_wait_for_keypress(True)
+
+# play the game with no window, taking key presses from keys until they run out,
+# the player dies or max_turns turns have passed. runs as fast as it can
+def play_headless(keys, max_turns=None):
+    global headless, input_keys, key
+
+    headless = True
+    input_keys = iter(keys)
+    turns = 0
+
+    while game_state == 'playing' and (max_turns is None or turns < max_turns):
+        frame_start = trace_clock()
+
+        with span('fov'):
+            update_fov()
+
+        key = next(input_keys, None)
+        if key is None:
+            break
+
+        with span('handle_keys'):
+            player_action = handle_keys()
+        if player_action == 'exit':
+            break
+
+        if game_state == 'playing' and player_action != 'didnt-take-turn':
+            with span('monsters'):
+                take_monster_turns()
+            turns += 1
+
+        add_span('frame', frame_start)
+
+    if timing:
+        stop_timing()
+
+    return turns
+
+def main():
+    global trace_file, MAP_WIDTH, MAP_HEIGHT, MAX_ROOMS, MAP_GENERATOR
+
+    parser = argparse.ArgumentParser(description='Lands of Lothariel')
+    parser.add_argument('--headless', action='store_true',
+        help='run the game rules with no window')
+    parser.add_argument('--turns', type=int, default=1000,
+        help='turns to play when headless (default 1000)')
+    parser.add_argument('--seed', type=int,
+        help='seed for the dungeon and everything in it, random by default')
+    parser.add_argument('--trace',
+        help='time every frame from the start and save the trace to this file')
+    parser.add_argument('--script',
+        help='file of key names to play when headless, default is a random walk')
+    parser.add_argument('--map-size', metavar='WIDTHxHEIGHT',
+        help='size of the dungeon levels, 80x43 by default. bigger maps scroll')
+    parser.add_argument('--generator', choices=sorted(MAP_GENERATORS),
+        help='how to lay out the levels, rooms (the default), bsp or caves')
+    parser.add_argument('--memory', action='store_true',
+        help='print the memory used by the game objects when headless')
+    args = parser.parse_args()
+
+    if args.trace:
+        trace_file = args.trace
+    if args.map_size:
+        (MAP_WIDTH, MAP_HEIGHT) = [int(n) for n in args.map_size.lower().split('x')]
+        # keep the rooms as thick on the ground as on a normal map
+        MAX_ROOMS = MAX_ROOMS * MAP_WIDTH * MAP_HEIGHT // (80 * 43)
+    if args.generator:
+        MAP_GENERATOR = args.generator
+
+    if not args.headless:
+        init_console()
+        new_game(args.seed)
+        if args.trace:
+            start_timing()
+        play_game()
+        levels.close()
+        return
+
+    if args.script:
+        with open(args.script) as f:
+            keys = scripted_keys(f.read().split())
+    else:
+        keys = random_walk_keys(args.seed or 0)
+
+    start = time.time()
+    new_game(args.seed)
+    if args.trace:
+        start_timing()
+    turns = play_headless(keys, args.turns)
+    elapsed = time.time() - start
 
-    # monsters turn
-    if game_state == 'playing' and player_action != 'didnt-take-turn':
-        for object in objects:
-            if object.ai:
-                object.ai.take_turn()
+    monsters = len(world.query('position', 'fighter')) - 1
+    print('seed %d: %d turns in %.2fs, player %s with %d/%d hp, %d monsters left' % (
+        game_seed, turns, elapsed, game_state, player.fighter.hp, player.fighter.max_hp, monsters))
+    if args.memory:
+        print_memory_report()
+    levels.close()
 
+if __name__ == '__main__':
+    # the level worker is started by running this again, which a frozen exe
+    # has to be told to expect
+    multiprocessing.freeze_support()
+    main()
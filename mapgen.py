@@ -0,0 +1,188 @@
+#! python2
+
+#############################
+#                           #
+# LANDS OF LOTHARIEL MAPGEN #
+#                           #
+#############################
+
+#
+# Makes lots of levels from consecutive seeds across every core, and reports
+# how they came out: how long each took, how many rooms, how much of the map is
+# floor, how many monsters and items per 100 floor cells, and whether all the
+# floor can be reached. For tuning the room and spawn settings without walking
+# round every level by hand.
+#
+#   python mapgen.py                            1000 levels, results in mapgen_stats.json
+#   python mapgen.py --count 5000 --rooms 40    more levels, more rooms in each
+#   python mapgen.py --thumbnails thumbs        also save a picture of every level
+#
+
+import argparse
+import json
+import multiprocessing
+import os
+import timeit
+
+import numpy
+
+import lothariel
+
+libtcod = lothariel.libtcod
+
+# thumbnail colors, one pixel per cell
+THUMB_WALL = libtcod.Color(0, 0, 0)
+THUMB_FLOOR = libtcod.Color(153, 204, 255)
+THUMB_MONSTER = libtcod.Color(255, 0, 0)
+THUMB_ITEM = libtcod.Color(255, 255, 0)
+
+# worker setup, run once in every process of the pool. settings are copied
+# into lothariel before it makes anything
+def init_worker(settings, depth, thumbnails):
+    global level_depth, thumbnail_dir
+    for (name, value) in settings.items():
+        setattr(lothariel, name, value)
+    level_depth = depth
+    thumbnail_dir = thumbnails
+
+def save_thumbnail(seed, floor):
+    (height, width) = floor.shape
+    image = libtcod.image_new(width, height)
+    for y in range(height):
+        for x in range(width):
+            libtcod.image_put_pixel(image, x, y, THUMB_FLOOR if floor[y, x] else THUMB_WALL)
+    world = lothariel.world
+    for obj in world.objects.values():
+        if obj.eid in world.position:
+            color = THUMB_MONSTER if obj.fighter else THUMB_ITEM
+            libtcod.image_put_pixel(image, obj.x, obj.y, color)
+    libtcod.image_save(image, os.path.join(thumbnail_dir, 'level%d.png' % seed))
+    libtcod.image_delete(image)
+
+# make the level for one seed and work out it's stats
+def map_stats(seed):
+    lothariel.seed_rngs(seed)
+    lothariel.seed_level_rngs(level_depth)
+    lothariel.world = lothariel.World()
+    lothariel.object_index = lothariel.SpatialIndex()
+
+    start = timeit.default_timer()
+    rooms = lothariel.make_map()
+    elapsed = timeit.default_timer() - start
+
+    tiles = lothariel.map
+    floor = ~tiles.blocked[0:tiles.height, 0:tiles.width]
+    floor_cells = numpy.count_nonzero(floor)
+    world = lothariel.world
+    monsters = len(world.fighter)
+    items = len(world.item)
+    # how much of the floor is in the area the player starts in
+    regions = lothariel.find_regions(tiles, rooms)
+    (x, y) = regions.spot(0) if rooms else (0, 0)
+    start_region = regions.region_at(x, y)
+    reached = regions.sizes[start_region] if start_region >= 0 else 0
+
+    if thumbnail_dir:
+        save_thumbnail(seed, floor)
+
+    return {
+        'seed': seed,
+        'time': elapsed,
+        'rooms': len(rooms),
+        'floor_coverage': float(floor_cells) / floor.size,
+        'monsters': monsters,
+        'items': items,
+        'monster_density': 100.0 * monsters / max(1, floor_cells),
+        'item_density': 100.0 * items / max(1, floor_cells),
+        'regions': len(regions.sizes),
+        'connected': float(reached) / max(1, floor_cells),
+    }
+
+# print the spread of every stat over all the levels
+def report(results, wall_time):
+    names = ['time', 'rooms', 'floor_coverage', 'monster_density', 'item_density',
+        'regions', 'connected']
+    print('%d levels in %.2fs' % (len(results), wall_time))
+    print('%-16s %10s %10s %10s' % ('', 'min', 'mean', 'max'))
+    for name in names:
+        values = [result[name] for result in results]
+        print('%-16s %10.4g %10.4g %10.4g' % (
+            name, min(values), float(sum(values)) / len(values), max(values)))
+    broken = [result['seed'] for result in results if result['regions'] > 1]
+    if broken:
+        print('%d levels with floor that can\'t be reached, seeds %s' % (
+            len(broken), ' '.join(str(seed) for seed in broken[:20])))
+
+def main():
+    parser = argparse.ArgumentParser(description='Lands of Lothariel level statistics')
+    parser.add_argument('--count', type=int, default=1000,
+        help='how many levels to make (default 1000)')
+    parser.add_argument('--first-seed', type=int, default=1,
+        help='seed of the first level, the rest count up from it (default 1)')
+    parser.add_argument('--depth', type=int, default=1,
+        help='dungeon depth to make the levels for (default 1)')
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(),
+        help='worker processes to use (default one per core)')
+    parser.add_argument('--map-size', metavar='WIDTHxHEIGHT',
+        help='size of the levels (default %dx%d)' % (lothariel.MAP_WIDTH, lothariel.MAP_HEIGHT))
+    parser.add_argument('--generator', choices=sorted(lothariel.MAP_GENERATORS),
+        default=lothariel.MAP_GENERATOR, help='map generator (default %(default)s)')
+    parser.add_argument('--rooms', type=int, default=lothariel.MAX_ROOMS,
+        help='MAX_ROOMS (default %(default)s)')
+    parser.add_argument('--room-min', type=int, default=lothariel.ROOM_MIN_SIZE,
+        help='ROOM_MIN_SIZE (default %(default)s)')
+    parser.add_argument('--room-max', type=int, default=lothariel.ROOM_MAX_SIZE,
+        help='ROOM_MAX_SIZE (default %(default)s)')
+    parser.add_argument('--monsters', type=int, default=lothariel.MAX_ROOM_MONSTERS,
+        help='MAX_ROOM_MONSTERS (default %(default)s)')
+    parser.add_argument('--items', type=int, default=lothariel.MAX_ROOM_ITEMS,
+        help='MAX_ROOM_ITEMS (default %(default)s)')
+    parser.add_argument('--thumbnails', metavar='DIR',
+        help='save a png of every level in this directory')
+    parser.add_argument('--output', default='mapgen_stats.json',
+        help='where to write the stats for every seed (default mapgen_stats.json)')
+    args = parser.parse_args()
+
+    (width, height) = (lothariel.MAP_WIDTH, lothariel.MAP_HEIGHT)
+    if args.map_size:
+        (width, height) = [int(n) for n in args.map_size.lower().split('x')]
+    settings = {
+        'MAP_WIDTH': width,
+        'MAP_HEIGHT': height,
+        'MAX_ROOMS': args.rooms,
+        'ROOM_MIN_SIZE': args.room_min,
+        'ROOM_MAX_SIZE': args.room_max,
+        'MAX_ROOM_MONSTERS': args.monsters,
+        'MAX_ROOM_ITEMS': args.items,
+        'MAP_GENERATOR': args.generator,
+    }
+    if args.thumbnails and not os.path.isdir(args.thumbnails):
+        os.makedirs(args.thumbnails)
+
+    seeds = range(args.first_seed, args.first_seed + args.count)
+    start = timeit.default_timer()
+    pool = multiprocessing.Pool(args.processes, init_worker,
+        (settings, args.depth, args.thumbnails))
+    try:
+        # hand out the seeds in batches, so the workers aren't waiting on the pool
+        chunk = max(1, args.count // (args.processes * 8))
+        results = pool.map(map_stats, seeds, chunk)
+    finally:
+        pool.close()
+        pool.join()
+    wall_time = timeit.default_timer() - start
+
+    report(results, wall_time)
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'settings': settings,
+            'depth': args.depth,
+            'processes': args.processes,
+            'wall_time': wall_time,
+            'levels': results,
+        }, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    main()